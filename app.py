@@ -1,16 +1,30 @@
+import os
 import sys
 import enum
+import time
+import inspect
+import logging
+import threading
 from typing import Union
 
 import networkx as nx
 import numpy as np
-import ricci_calculator as rc
+import calculators
+import graph_io
+import layout
+import result_cache
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+from experiments import ricci_calculators as pyrc
 from PyQt5.QtWidgets import QMainWindow, QApplication, \
     QPushButton, QVBoxLayout, QHBoxLayout, QWidget, QLabel, \
-    QRadioButton, QGroupBox, QFileDialog
+    QRadioButton, QGroupBox, QFileDialog, QCheckBox
 from PyQt5.QtGui import QPalette, QPainter, QBrush, QPen, \
-    QColor, QMouseEvent, QWheelEvent, QPainterPath
-from PyQt5.QtCore import QPointF, Qt
+    QColor, QMouseEvent, QWheelEvent, QPainterPath, QPixmap, QFont
+from PyQt5.QtCore import QPointF, QLineF, QRectF, Qt, QObject, QRunnable, QThreadPool, pyqtSignal
+
+# milliseconds closing the window waits for the stopped tasks to return
+CLOSE_WAIT_MS = 2000
 
 
 class MouseState(enum.Enum):
@@ -20,6 +34,60 @@ class MouseState(enum.Enum):
     move_vertex = 3
 
 
+def refine_layout(steps, key: str):
+    """Pass on the coordinates of a layout generator, save the final ones to the cache."""
+    coords = None
+    for coords in steps:
+        yield coords
+    if coords is not None:
+        layout.save_layout(key, coords)
+
+
+class TaskSignals(QObject):
+    progress = pyqtSignal(int, str, object)
+    finished = pyqtSignal(int, str, object)
+    failed = pyqtSignal(int, str, object)
+
+
+class Task(QRunnable):
+    """Runs func(*args) on a thread pool, reports the result with signals.
+
+    If func returns a generator, every value it yields is reported with
+    progress and the last one with finished. cancel() stops it between values
+    and makes the calculators raise pyrc.Stopped; a stopped task reports nothing.
+    """
+
+    def __init__(self, generation: int, key: str, func, *args):
+        super().__init__()
+        self.generation = generation
+        self.key = key
+        self.func = func
+        self.args = args
+        self.signals = TaskSignals()
+        self.stop = threading.Event()
+
+    def cancel(self):
+        self.stop.set()
+
+    def run(self):
+        try:
+            with pyrc.phase('task.' + self.key), pyrc.stop_on(self.stop):
+                result = self.func(*self.args)
+                if inspect.isgenerator(result):
+                    steps, result = result, None
+                    for result in steps:
+                        if self.stop.is_set():
+                            steps.close()
+                            return
+                        self.signals.progress.emit(self.generation, self.key, result)
+        except pyrc.Stopped:
+            return
+        except Exception as e:
+            self.signals.failed.emit(self.generation, self.key, e)
+        else:
+            self.signals.finished.emit(self.generation, self.key, result)
+
+
 class GraphView(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -49,6 +117,8 @@ class GraphView(QWidget):
         self.max_edge_color = QColor(255, 0, 0)  # red
         self.min_edge_color = QColor(0, 0, 255)  # blue
         self.highlight_color = QColor(0, 255, 0)  # yellow
+        self.edge_lut_size = 256
+        self.edge_lut = [self._get_edge_color(i / (self.edge_lut_size-1)) for i in range(self.edge_lut_size)]
 
         self.mouse = MouseState.released
         self.mouse_pos = None
@@ -57,25 +127,73 @@ class GraphView(QWidget):
         self.offset = None
         self.v_offsets = None
 
-        self.graph = None
-        self.params = None
+        # edge list model: edge k goes from src[k] to dst[k]
+        self.src = None
+        self.dst = None
+        self.weights = None
+        self.params = {}
         self.curr_param = -1
         self.vertex_count = 0
         self.coords = None
+        # refinement of the layout and its cache key, taken by the main window
+        self.layout_steps = None
+        self.layout_key = None
         self.symmertic = True
         self.highlighted_edge = None
+        self.grid = SpatialGrid()
+        # scene rendered at the start of a pan and its offset
+        self.pan_cache = None
+        self.lod_edge_count = 20000
+        # performance overlay: frame time and phases of the last load
+        self.show_profile = False
+        self.frame_time = 0.
+        self.overlay_lines = 14
 
         self._init_graph()
         self.reset(True)
 
     def paintEvent(self, event):
+        start = time.perf_counter()
         painter = QPainter(self)
-        painter.setRenderHint(QPainter.Antialiasing)
         w, h = painter.viewport().width(), painter.viewport().height()
+        with pyrc.phase('paint'):
+            if self.pan_cache is not None:
+                # pure pan: shift the scene rendered when the pan started,
+                # render it again once the pan goes past its margin
+                pixmap, cached_offset = self.pan_cache
+                shift = self.offset - cached_offset
+                if abs(shift[0]) > w or abs(shift[1]) > h:
+                    self.pan_cache = self._render_pan_cache()
+                    pixmap, cached_offset = self.pan_cache
+                    shift = self.offset - cached_offset
+                painter.drawPixmap(QPointF(shift[0] - w, shift[1] - h), pixmap)
+            else:
+                self._render(painter, w, h)
+        if self.show_profile:
+            self._draw_overlay(painter)
+        self.frame_time = time.perf_counter() - start
+
+    def _render(self, painter: QPainter, w: int, h: int):
+        painter.setRenderHint(QPainter.Antialiasing)
         painter.setWindow(-w//2, -h//2, w, h)
 
-        self._draw_edges(painter)
-        self._draw_vertices(painter)
+        centers = self._v_centers(np.arange(self.vertex_count))
+        # everything that can reach into the window: vertices, edge widths, curves and arrows
+        margin = self.scale * max(
+            self.vertex_radius, self.edge_size * self.highlight_mul,
+            self.orient_edge_control_offset + self.triangle_size * 1.5
+        )
+        window = np.array([[-w/2 - margin, -h/2 - margin], [w/2 + margin, h/2 + margin]])
+        edges = self._visible_edges(centers, window)
+        # too many edges on screen: skip arrows and merge vertices in the same pixel
+        lod = len(edges) > self.lod_edge_count
+
+        self._draw_edges(painter, centers, edges, not lod)
+        vertices = np.flatnonzero(((centers >= window[0]) & (centers <= window[1])).all(axis=1))
+        if lod:
+            _, first = np.unique(np.round(centers[vertices]).astype(np.int64), axis=0, return_index=True)
+            vertices = vertices[np.sort(first)]
+        self._draw_vertices(painter, centers[vertices])
 
     def mousePressEvent(self, a0: QMouseEvent) -> None:
         if a0.button() == Qt.LeftButton:
@@ -84,26 +202,18 @@ class GraphView(QWidget):
                 a0.localPos().y() - self.height() / 2
             ])
             self.mouse = MouseState.down_idle
-            for i in range(self.vertex_count):
-                if self._inside_v(i, self.mouse_pos):
-                    self.mouse = MouseState.move_vertex
-                    self.moved_vertex = i
-                    return
-
-            closest_len2 = float('inf')
-            closest_edge = (1, 1)
-            for i in range(self.vertex_count):
-                for j in range(self.vertex_count):
-                    if i == j:
-                        continue
-                    if self.graph[i, j] != 0:
-                        if (curr_dist := self._distance_to_e2(i, j, self.mouse_pos)) < closest_len2:
-                            closest_len2 = curr_dist
-                            closest_edge = (i, j)
-            if closest_len2 <= self.edge_detection_threshold_absolute:
-                self.highlighted_edge = closest_edge
-            else:
-                self.highlighted_edge = None
+            # grid works in graph coordinates, thresholds are in screen pixels
+            radius = max(self.vertex_radius * self.scale, np.sqrt(self.edge_detection_threshold_absolute))
+            if not self.symmertic:
+                radius += self.orient_edge_control_offset * self.scale / 2
+            vertices, edges = self.grid.query((self.mouse_pos - self.offset) / self.scale, radius / self.scale)
+
+            if (vertex := self._pick_vertex(self.mouse_pos, vertices)) is not None:
+                self.mouse = MouseState.move_vertex
+                self.moved_vertex = vertex
+                return
+
+            self.highlighted_edge = self._pick_edge(self.mouse_pos, edges)
             self._update_info()
             self.repaint()
 
@@ -118,6 +228,7 @@ class GraphView(QWidget):
         else:
             if self.mouse == MouseState.down_idle:
                 self.mouse = MouseState.move_field
+                self.pan_cache = self._render_pan_cache()
             self._move_field(pos)
 
         self.mouse_pos = pos
@@ -126,6 +237,11 @@ class GraphView(QWidget):
     def mouseReleaseEvent(self, a0: QMouseEvent) -> None:
         if a0.button() == Qt.LeftButton:
             self.mouse = MouseState.released
+            if self.grid.moved:
+                self.grid.build(self.coords + self.v_offsets, self.src, self.dst)
+            if self.pan_cache is not None:
+                self.pan_cache = None
+                self.repaint()
 
     def wheelEvent(self, a0: QWheelEvent) -> None:
         prev_scale = self.scale
@@ -133,26 +249,58 @@ class GraphView(QWidget):
         self.scale = min(self.max_scale, max(self.min_scale, self.scale))
         pos = np.array([a0.position().x() - self.width()/2, a0.position().y() - self.height()/2])
         self.offset += (1 - self.scale / prev_scale) * (pos - self.offset)
+        self._refresh_pan_cache()
         self.repaint()
 
     def connect_info_field(self, a0):
         self.info_field = a0
         self.info_field_default_text = a0.text()
 
-    def set_graph(self, mat: np.ndarray):
-        self.graph = mat
-        self.symmertic = (mat.T == mat).all().all()
-        self.vertex_count = self.graph.shape[0]
-        pos = nx.spring_layout(
-            nx.from_numpy_array(self.graph),
-            k=np.sqrt(np.sqrt(rc.connected_components(self.graph))/self.vertex_count)
-        )
-        self.coords = np.array(list(pos.values()), dtype=np.float32) * self.graph_convert_scale
-        self.reset(True)
+    def set_graph(self, graph: graph_io.EdgeGraph):
+        self.symmertic = not graph.directed
+        self.vertex_count = graph.n
+        # symmetric graphs keep every edge once, self-loops are not shown
+        self.src = np.asarray(graph.src)
+        self.dst = np.asarray(graph.dst)
+        self.weights = np.asarray(graph.weights)
+
+        with pyrc.phase('set_graph.components'):
+            adj = sp.coo_array((self.weights, (self.src, self.dst)), shape=(graph.n, graph.n))
+            k = np.sqrt(np.sqrt(connected_components(adj, directed=False)[0])/self.vertex_count)
+        # a graph seen before gets its final layout from the cache, otherwise the
+        # first rough steps are shown and the rest is left to self.layout_steps
+        with pyrc.phase('set_graph.layout'):
+            self.layout_key = layout.adjacency_key(self.vertex_count, self.src, self.dst, self.weights, k)
+            pos = layout.load_layout(self.layout_key, self.vertex_count)
+            self.layout_steps = None
+            if pos is None:
+                self.layout_steps = layout.force_layout(self.vertex_count, self.src, self.dst, self.weights, k)
+                pos = next(self.layout_steps)
+        self.coords = np.asarray(pos, dtype=np.float32) * self.graph_convert_scale
+        self.params = {}
+        self.highlighted_edge = None
+        self._update_info()
+        with pyrc.phase('set_graph.grid'):
+            self.reset(True)
+        self.repaint()
+
+    def set_coords(self, pos: np.ndarray):
+        """Replace the layout, keeping the vertex moves made by the user."""
+        self.coords = np.asarray(pos, dtype=np.float32) * self.graph_convert_scale
+        self.grid.build(self.coords + self.v_offsets, self.src, self.dst)
+        self._refresh_pan_cache()
         self.repaint()
 
     def set_params(self, **kwargs):
-        self.params = kwargs
+        """Add or replace edge parameters; the rest stay as they are.
+
+        Values are either edge-aligned arrays or n x n matrices.
+        """
+        for key, value in kwargs.items():
+            value = np.asarray(value)
+            self.params[key] = value[self.src, self.dst] if value.ndim == 2 else value
+        self._update_info()
+        self._refresh_pan_cache()
         self.repaint()
 
     def change_param(self, key: Union[int, str]):
@@ -164,116 +312,168 @@ class GraphView(QWidget):
         self.scale = 1
         if hard:
             self.v_offsets = np.zeros(self.coords.shape)
+            self.grid.build(self.coords + self.v_offsets, self.src, self.dst)
         self.repaint()
 
     def _init_graph(self):
         # probably will not be used, but for a good measure
-        self.set_graph(np.array([
+        self.set_graph(graph_io.from_matrix(np.array([
             [0, 1, 0, 0],
             [1, 0, 1, 0],
             [0, 1, 0, 1],
             [0, 0, 1, 0],
-        ]))
+        ])))
 
     def _update_info(self):
+        if self.info_field is None:
+            return
         if self.highlighted_edge is None:
             self.info_field.setText(self.info_field_default_text)
             return
-        (i, j) = self.highlighted_edge
+        k = self.highlighted_edge
+
+        def value(key):
+            if key not in self.params:
+                return 'computing...'
+            return '%0.5f' % self.params[key][k]
+
         self.info_field.setText(
-            'Edge weight:  \t\t%0.5f\n' % self.graph[i, j]
-            + 'Ollivier curvature:  \t%0.5f\n' % self.params['ollivier'][i, j]
-            + 'Ollivier flow:  \t\t%0.5f\n' % self.params['oflow'][i, j]
-            + 'Forman curvature:  \t%0.5f\n' % self.params['forman'][i, j]
-            + 'Forman flow:  \t\t%0.5f\n' % self.params['fflow'][i, j]
+            'Edge weight:  \t\t%0.5f\n' % self.weights[k]
+            + 'Ollivier curvature:  \t%s\n' % value('ollivier')
+            + 'Ollivier flow:  \t\t%s\n' % value('oflow')
+            + 'Forman curvature:  \t%s\n' % value('forman')
+            + 'Forman flow:  \t\t%s\n' % value('fflow')
         )
 
     def _move_vertex(self, pos: np.ndarray):
         self.v_offsets[self.moved_vertex] += (pos - self.mouse_pos) / self.scale
+        self.grid.move(self.moved_vertex)
 
     def _move_field(self, pos: np.ndarray):
         self.offset += pos - self.mouse_pos
 
-    def _draw_vertices(self, painter: QPainter):
+    def _render_pan_cache(self):
+        """Render the scene with a margin of one view on every side for panning."""
+        w, h = self.width(), self.height()
+        ratio = self.devicePixelRatioF()
+        pixmap = QPixmap(int(3 * w * ratio), int(3 * h * ratio))
+        pixmap.setDevicePixelRatio(ratio)
+        pixmap.fill(self.palette().color(QPalette.Base))
+        painter = QPainter(pixmap)
+        self._render(painter, 3 * w, 3 * h)
+        painter.end()
+        return pixmap, self.offset.copy()
+
+    def _refresh_pan_cache(self):
+        if self.pan_cache is not None:
+            self.pan_cache = self._render_pan_cache()
+
+    def _draw_overlay(self, painter: QPainter):
+        """Frame time and the slowest phases since the last load, in the top left corner."""
+        lines = ['frame: %.1f ms' % (self.frame_time * 1000)]
+        profiler = pyrc.get_profiler()
+        if profiler is None:
+            lines.append('profiling is off')
+        else:
+            totals, counts = profiler.snapshot()
+            phases = sorted(((t, name) for name, t in totals.items() if name != 'paint'), reverse=True)
+            lines.append('last load:' if phases else 'open a graph to profile its load')
+            lines += ['%-24s %8.3f s' % (name, t) for t, name in phases[:self.overlay_lines]]
+            lines += ['%-24s %8d' % (name, n) for name, n in sorted(counts.items())]
+
+        painter.resetTransform()
+        painter.setWindow(0, 0, self.width(), self.height())
+        font = QFont('monospace', 8)
+        font.setStyleHint(QFont.TypeWriter)
+        painter.setFont(font)
+        metrics = painter.fontMetrics()
+        box = QRectF(4, 4, max(metrics.horizontalAdvance(line) for line in lines) + 12,
+                     metrics.height() * len(lines) + 8)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QBrush(QColor(255, 255, 255, 220)))
+        painter.drawRect(box)
+        painter.setPen(QPen(QColor(0, 0, 0)))
+        for i, line in enumerate(lines):
+            painter.drawText(QPointF(10, 8 + metrics.ascent() + i * metrics.height()), line)
+
+    def _visible_edges(self, centers: np.ndarray, window: np.ndarray) -> np.ndarray:
+        a = centers[self.src]
+        b = centers[self.dst]
+        low = np.minimum(a, b)
+        high = np.maximum(a, b)
+        return np.flatnonzero(((high >= window[0]) & (low <= window[1])).all(axis=1))
+
+    def _draw_vertices(self, painter: QPainter, centers: np.ndarray):
         painter.setBrush(QBrush(self.vertex_color))
         painter.setPen(QPen(self.vertex_border_color, 0.5))
-        for i in range(self.vertex_count)[::-1]:
-            self._draw_vertex(painter, i)
-
-    def _draw_vertex(self, painter: QPainter, i: int):
-        painter.drawEllipse(
-            self._calc_coord(i),
-            self.scale * self.vertex_radius,
-            self.scale * self.vertex_radius
-        )
-
-    def _draw_edges(self, painter: QPainter):
-        if self.curr_param == -1:
-            mode = 1
-            norm_param = self.graph
-        else:
-            mode = -1
-            norm_param = self.params[self.curr_param]
-            n_min = norm_param[self.graph != 0].min()
-            n_delta = norm_param[self.graph != 0].max() - n_min
-            if n_delta == 0:
-                norm_param = np.ones(norm_param.shape) / 2  # set 0.5 everywhere
-            else:
-                norm_param = (norm_param - n_min) / n_delta
+        r = self.scale * self.vertex_radius
+        for x, y in centers[::-1].tolist():
+            painter.drawEllipse(QPointF(x, y), r, r)
 
+    def _draw_edges(self, painter: QPainter, centers: np.ndarray, edges: np.ndarray, arrows: bool):
+        width = self.scale * self.edge_size
         if self.highlighted_edge is not None:
-            self._highlight_edge(painter)
+            self._draw_edge_group(
+                painter, centers, np.array([self.highlighted_edge]),
+                self.highlight_color, self.scale * (self.edge_size*self.highlight_mul), True
+            )
 
-        for i in range(self.vertex_count):
-            for j in range(i+1, self.vertex_count):
-                if self.symmertic:
-                    self._draw_edge_sym(painter, i, j, mode, norm_param[i, j])
-                else:
-                    self._draw_edge_ori(painter, i, j, mode, norm_param[i, j])
-                    self._draw_edge_ori(painter, j, i, mode, norm_param[j, i])
+        if self.curr_param not in self.params:
+            # plain edges, also while the parameter is being computed
+            self._draw_edge_group(painter, centers, edges, self.default_edge_color, width, arrows)
+            return
 
-    def _highlight_edge(self, painter: QPainter):
-        if self.symmertic:
-            self._draw_edge_sym(painter, *self.highlighted_edge, -2, 0)
+        norm_param = self.params[self.curr_param]
+        if not len(norm_param):
+            return
+        n_min = norm_param.min()
+        n_delta = norm_param.max() - n_min
+        if n_delta == 0:
+            norm_param = np.ones(norm_param.shape) / 2  # set 0.5 everywhere
         else:
-            self._draw_edge_ori(painter, *self.highlighted_edge, -2, 0)
-
-    def _draw_edge_sym(self, painter: QPainter, i: int, j: int, mode: int, coef: float):
-        if self.graph[i, j] == 0:
+            norm_param = (norm_param - n_min) / n_delta
+
+        # one draw call per color of the lookup table
+        buckets = np.minimum((norm_param[edges] * len(self.edge_lut)).astype(np.int64), len(self.edge_lut) - 1)
+        order = np.argsort(buckets, kind='stable')
+        bounds = np.searchsorted(buckets[order], np.arange(len(self.edge_lut) + 1))
+        for color, lo, hi in zip(self.edge_lut, bounds[:-1], bounds[1:]):
+            if lo < hi:
+                self._draw_edge_group(painter, centers, edges[order[lo:hi]], color, width, arrows)
+
+    def _draw_edge_group(self, painter: QPainter, centers: np.ndarray, ids: np.ndarray,
+                         color: QColor, width: float, arrows: bool):
+        painter.setPen(QPen(color, width))
+        a = centers[self.src[ids]]
+        b = centers[self.dst[ids]]
+        if self.symmertic:
+            painter.drawLines([QLineF(*line) for line in np.hstack([a, b]).tolist()])
             return
-        self._set_pen(painter, mode, coef)
-        painter.drawLine(
-            self._calc_coord(i),
-            self._calc_coord(j)
-        )
 
-    def _draw_edge_ori(self, painter: QPainter, i: int, j: int, mode: int, coef: float):
-        if self.graph[i, j] == 0:
-            return
-        self._set_pen(painter, mode, coef)
-        path = QPainterPath()
-        path.moveTo(self._calc_coord(i))
-        a = self._v_center(i)
-        b = self._v_center(j)
-        ban = np.array([[0, 1.], [-1., 0]]) @ (b - a)
-        ban /= np.linalg.norm(ban)
+        ban = (b - a) @ np.array([[0, 1.], [-1., 0]]).T
+        ban /= np.linalg.norm(ban, axis=1, keepdims=True)
         ban *= self.orient_edge_control_offset * self.scale
         c1 = a + ban
         c2 = b + ban
-
-        path.cubicTo(QPointF(*c1), QPointF(*c2), self._calc_coord(j))
-
-        self._draw_arrow_at(painter, path, 0.55)
+        path = QPainterPath()
+        for ax, ay, c1x, c1y, c2x, c2y, bx, by in np.hstack([a, c1, c2, b]).tolist():
+            path.moveTo(ax, ay)
+            path.cubicTo(c1x, c1y, c2x, c2y, bx, by)
+        painter.setBrush(Qt.NoBrush)
         painter.drawPath(path)
 
-    def _draw_arrow_at(self, painter: QPainter, path: QPainterPath, where: float):
-        real_point = path.pointAtPercent(where)
-        real_point = np.array([real_point.x(), real_point.y()])
-        other_point = path.pointAtPercent(where+0.01)
-        other_point = np.array([other_point.x(), other_point.y()])
-        delta = other_point - real_point
-        delta /= np.linalg.norm(delta)
-        delta_perp = np.array([[0, 1.], [-1., 0]]) @ delta
+        if arrows:
+            painter.setBrush(QBrush(color))
+            painter.drawPath(self._arrows_path(a, c1, c2, b, 0.55))
+
+    def _arrows_path(self, a: np.ndarray, c1: np.ndarray, c2: np.ndarray, b: np.ndarray,
+                     where: float) -> QPainterPath:
+        """Triangles pointing along the cubic curves (a, c1, c2, b) at parameter where."""
+        t = where
+        real_point = (1-t)**3 * a + 3*(1-t)**2*t * c1 + 3*(1-t)*t**2 * c2 + t**3 * b
+        delta = 3*(1-t)**2 * (c1 - a) + 6*(1-t)*t * (c2 - c1) + 3*t**2 * (b - c2)
+        delta /= np.linalg.norm(delta, axis=1, keepdims=True)
+        delta_perp = delta @ np.array([[0, 1.], [-1., 0]]).T
 
         ts = self.triangle_size * self.scale
 
@@ -281,13 +481,12 @@ class GraphView(QWidget):
         p2 = real_point + delta * ts * 1.5
         p3 = real_point - delta_perp * ts/2
         tripath = QPainterPath()
-        tripath.moveTo(*p1)
-        tripath.lineTo(*p2)
-        tripath.lineTo(*p3)
-        tripath.lineTo(*p1)
-
-        painter.fillPath(tripath, QBrush(painter.pen().color()))
-        painter.drawPath(tripath)
+        for x1, y1, x2, y2, x3, y3 in np.hstack([p1, p2, p3]).tolist():
+            tripath.moveTo(x1, y1)
+            tripath.lineTo(x2, y2)
+            tripath.lineTo(x3, y3)
+            tripath.closeSubpath()
+        return tripath
 
     def _get_edge_color(self, coef: float):
         return QColor(
@@ -305,56 +504,131 @@ class GraphView(QWidget):
             )
         )
 
-    def _set_pen(self, painter: QPainter, mode: int, coef: float = None):
-        if mode == 1:
-            painter.setPen(QPen(self.default_edge_color, self.scale * self.edge_size))
-        elif mode == -1:
-            curr_col = self._get_edge_color(coef)
-            painter.setPen(QPen(curr_col, self.scale * self.edge_size))
-        elif mode == -2:
-            painter.setPen(QPen(self.highlight_color, self.scale * (self.edge_size*self.highlight_mul)))
+    def _v_centers(self, ids: np.ndarray) -> np.ndarray:
+        return self.scale * (self.coords[ids] + self.v_offsets[ids]) + self.offset
 
-    def _v_center(self, i: int) -> np.ndarray:
-        return self.scale * (self.coords[i] + self.v_offsets[i]) + self.offset
+    def _pick_vertex(self, other: np.ndarray, candidates: np.ndarray) -> Union[int, None]:
+        dist2 = ((self._v_centers(candidates) - other)**2).sum(axis=1)
+        inside = candidates[dist2 < (self.vertex_radius * self.scale)**2]
+        # vertices with lower indices are drawn on top
+        return int(inside.min()) if len(inside) else None
 
-    def _calc_coord(self, i: int) -> QPointF:
-        return QPointF(*self._v_center(i))
-
-    def _inside_v(self, vertex_i: int, other: np.ndarray) -> bool:
-        vertex = self._v_center(vertex_i)
-        dist2 = ((vertex - other)**2).sum()
-        return dist2 < (self.vertex_radius * self.scale)**2
-
-    @staticmethod
-    def _dist_to_segment2(a: np.ndarray, b: np.ndarray, p: np.ndarray) -> float:
-        def d2(x, y):
-            return ((x - y)**2).sum()
-        e_len2 = d2(a, b)
-        if e_len2 == 0:
-            return d2(a, p)
-        t = min(1, max(0, np.dot(p - a, b - a) / e_len2))
-        proj = a + t * (b - a)
-        return d2(proj, p)
-
-    def _distance_to_e2(self, i: int, j: int, other: np.ndarray) -> float:
-        if self.symmertic:
-            return self._dist_to_segment2(self._v_center(i), self._v_center(j), other)
-        else:
-            offset = self._v_center(j) - self._v_center(i)
-            offset = np.array([[0, 1.], [-1., 0]]) @ offset
+    def _pick_edge(self, other: np.ndarray, candidates: np.ndarray) -> Union[int, None]:
+        a = self._v_centers(self.src[candidates])
+        b = self._v_centers(self.dst[candidates])
+        if not self.symmertic:
+            offset = (b - a) @ np.array([[0, 1.], [-1., 0]]).T
             offset = (
-                    offset / np.linalg.norm(offset)
+                    offset / np.linalg.norm(offset, axis=1, keepdims=True)
                     * self.orient_edge_control_offset * self.scale / 2
             )
-            return self._dist_to_segment2(
-                self._v_center(i)+offset,
-                self._v_center(j)+offset,
-                other
-            )
+            a = a + offset
+            b = b + offset
+        dist2 = self._dist_to_segments2(a, b, other)
+        if not len(dist2) or dist2.min() > self.edge_detection_threshold_absolute:
+            return None
+        # the first of equally close edges, as candidates are sorted
+        return int(candidates[np.argmin(dist2)])
+
+    @staticmethod
+    def _dist_to_segments2(a: np.ndarray, b: np.ndarray, p: np.ndarray) -> np.ndarray:
+        ab = b - a
+        e_len2 = (ab**2).sum(axis=1)
+        t = np.divide(((p - a) * ab).sum(axis=1), e_len2, out=np.zeros(len(a)), where=e_len2 != 0)
+        proj = a + np.clip(t, 0, 1)[:, None] * ab
+        return ((proj - p)**2).sum(axis=1)
+
+
+class SpatialGrid:
+    """Uniform grid over vertex positions and edge bounding boxes.
+
+    query() returns the vertices and edges that may lie near a point, sorted.
+    Vertices moved after build() are kept aside and returned by every query
+    together with their edges, until the next build().
+    """
+
+    max_edge_cells = 64
+
+    def __init__(self):
+        self.cell = 1.
+        self.origin = np.zeros(2)
+        self.shape = (0, 0)
+        self.v_keys = self.v_ids = np.zeros(0, dtype=np.int64)
+        self.e_keys = self.e_ids = np.zeros(0, dtype=np.int64)
+        self.long_edges = np.zeros(0, dtype=np.int64)
+        self.inc_ptr = np.zeros(1, dtype=np.int64)
+        self.inc_edges = np.zeros(0, dtype=np.int64)
+        self.moved = set()
+
+    def build(self, points: np.ndarray, src: np.ndarray, dst: np.ndarray):
+        n = len(points)
+        lengths = np.linalg.norm(points[src] - points[dst], axis=1)
+        span = (points.max(axis=0) - points.min(axis=0)).max() if n else 1.
+        # about two vertices per cell, smaller if edges are short
+        self.cell = 2 * span / max(1., np.sqrt(n))
+        if len(lengths):
+            self.cell = min(self.cell, np.median(lengths))
+        self.cell = max(self.cell, span / 4096, 1e-6)
+        self.origin = points.min(axis=0) if n else np.zeros(2)
+
+        cells = self._cells(points)
+        self.shape = tuple(cells.max(axis=0) + 1) if n else (0, 0)
+        self.v_keys, self.v_ids = self._sorted(self._keys(cells), np.arange(n))
+
+        # every edge goes to all cells of its bounding box, except long ones
+        lo = np.minimum(cells[src], cells[dst])
+        size = np.abs(cells[src] - cells[dst]) + 1
+        count = size[:, 0] * size[:, 1]
+        is_long = count > self.max_edge_cells
+        self.long_edges = np.flatnonzero(is_long)
+        ids = np.flatnonzero(~is_long)
+        rep = np.repeat(ids, count[ids])
+        local = np.arange(len(rep)) - np.repeat(np.cumsum(count[ids]) - count[ids], count[ids])
+        edge_cells = lo[rep] + np.column_stack([local // size[rep, 1], local % size[rep, 1]])
+        self.e_keys, self.e_ids = self._sorted(self._keys(edge_cells), rep)
+
+        ends = np.concatenate([src, dst])
+        order = np.argsort(ends, kind='stable')
+        self.inc_edges = np.concatenate([np.arange(len(src))] * 2)[order]
+        self.inc_ptr = np.concatenate([[0], np.cumsum(np.bincount(ends, minlength=n))])
+        self.moved = set()
+
+    def move(self, vertex: int):
+        self.moved.add(vertex)
+
+    def query(self, point: np.ndarray, radius: float):
+        c0 = np.maximum(self._cells(point - radius), 0)
+        c1 = np.minimum(self._cells(point + radius), np.array(self.shape) - 1)
+        keys = self._keys(np.array([
+            (x, y) for x in range(c0[0], c1[0]+1) for y in range(c0[1], c1[1]+1)
+        ], dtype=np.int64).reshape(-1, 2))
+
+        moved = np.array(sorted(self.moved), dtype=np.int64)
+        vertices = [self._lookup(self.v_keys, self.v_ids, keys), moved]
+        edges = [self._lookup(self.e_keys, self.e_ids, keys), self.long_edges]
+        edges += [self.inc_edges[self.inc_ptr[v]:self.inc_ptr[v+1]] for v in moved.tolist()]
+        return np.unique(np.concatenate(vertices)), np.unique(np.concatenate(edges))
+
+    def _cells(self, points: np.ndarray) -> np.ndarray:
+        return np.floor((points - self.origin) / self.cell).astype(np.int64)
+
+    def _keys(self, cells: np.ndarray) -> np.ndarray:
+        return cells[:, 0] * max(self.shape[1], 1) + cells[:, 1]
+
+    @staticmethod
+    def _sorted(keys: np.ndarray, ids: np.ndarray):
+        order = np.argsort(keys, kind='stable')
+        return keys[order], ids[order]
+
+    @staticmethod
+    def _lookup(sorted_keys: np.ndarray, ids: np.ndarray, keys: np.ndarray) -> np.ndarray:
+        lo = np.searchsorted(sorted_keys, keys, 'left')
+        hi = np.searchsorted(sorted_keys, keys, 'right')
+        return np.concatenate([ids[a:b] for a, b in zip(lo, hi)] + [np.zeros(0, dtype=np.int64)])
 
 
 class MainWindow(QMainWindow):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, profiler: Union[pyrc.Profiler, None] = None, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.resize(800, 600)
@@ -370,8 +644,21 @@ class MainWindow(QMainWindow):
         self.refresh_button = QPushButton(self)
         self.random_graph_button = QPushButton(self)
         self.open_graph_button = QPushButton(self)
+        self.profile_check = QCheckBox(self)
 
         self.graph = None
+        self.graph_key = None
+        self.results = result_cache.ResultCache()
+        self.pool = QThreadPool(self)
+        self.generation = 0
+        self.tasks = {}
+        self.profiler = profiler if profiler is not None else pyrc.Profiler()
+        self.measure_buttons = {
+            'ollivier': (self.vt_ollivier_rb, 'Ollivier curvature'),
+            'oflow': (self.vt_oflow_rb, 'Ollivier flow'),
+            'forman': (self.vt_forman_rb, 'Forman curvature'),
+            'fflow': (self.vt_fflow_rb, 'Forman flow'),
+        }
 
         self._init_ui()
         self._init_elements()
@@ -392,6 +679,7 @@ class MainWindow(QMainWindow):
         right_layout.addWidget(self.refresh_button)
         right_layout.addWidget(self.open_graph_button)
         right_layout.addWidget(self.random_graph_button)
+        right_layout.addWidget(self.profile_check)
         for i in range(right_layout.count()):
             right_layout.itemAt(i).widget().setFixedWidth(250)
 
@@ -405,8 +693,8 @@ class MainWindow(QMainWindow):
 
     def _init_elements(self):
         self._init_info()
-        self._init_graph()
         self._init_view_type()
+        self._init_graph()
         self._init_buttons()
         self.show()
 
@@ -422,13 +710,11 @@ class MainWindow(QMainWindow):
         self.view_type_box.setTitle('Edge information')
         self.vt_default_rb.setText('Plain edges')
         self.vt_default_rb.toggled.connect(self.set_default_view)
-        self.vt_ollivier_rb.setText('Ollivier curvature')
+        for button, text in self.measure_buttons.values():
+            button.setText(text)
         self.vt_ollivier_rb.toggled.connect(self.set_ollivier_view)
-        self.vt_oflow_rb.setText('Ollivier flow')
         self.vt_oflow_rb.toggled.connect(self.set_oflow_view)
-        self.vt_forman_rb.setText('Forman curvature')
         self.vt_forman_rb.toggled.connect(self.set_forman_view)
-        self.vt_fflow_rb.setText('Forman flow')
         self.vt_fflow_rb.toggled.connect(self.set_fflow_view)
 
         self.vt_default_rb.setChecked(True)
@@ -440,6 +726,8 @@ class MainWindow(QMainWindow):
         self.open_graph_button.clicked.connect(self.open_graph)
         self.random_graph_button.setText('Random graph')
         self.random_graph_button.clicked.connect(self.random_graph)
+        self.profile_check.setText('Performance overlay')
+        self.profile_check.toggled.connect(self.toggle_profile)
 
     def set_default_view(self):
         if self.sender().isChecked():
@@ -464,34 +752,128 @@ class MainWindow(QMainWindow):
     def reset_handler(self):
         self.view.reset()
 
+    def toggle_profile(self, checked: bool):
+        # profiling requested with RICCI_PROFILE stays on without the overlay
+        if checked:
+            pyrc.set_profiler(self.profiler)
+        elif not self.profiler.collectors:
+            pyrc.set_profiler(None)
+        self.view.show_profile = checked
+        self.view.repaint()
+
     def open_graph(self):
         path = QFileDialog.getOpenFileName(
             self, 'Open graph', '',
-            'NumPy pickled graphs (*.npy *.npz)'
+            'NumPy graphs (*.npy *.npz);;Edge lists (%s);;All files (*)'
+            % ' '.join('*' + ext for ext in graph_io.EDGE_LIST_EXTENSIONS)
         )
         if path[0] != '':
-            graph = np.load(path[0])
+            try:
+                graph = graph_io.load_graph(path[0])
+            except (OSError, ValueError) as e:
+                print('cannot open %s: %s' % (path[0], e), file=sys.stderr)
+                return
             self._set_new_graph(graph)
 
     def random_graph(self):
         graph = nx.to_numpy_array(nx.random_geometric_graph(116, 0.1), dtype=float)
-        self._set_new_graph(graph)
+        self._set_new_graph(graph_io.from_matrix(graph))
+
+    def closeEvent(self, a0) -> None:
+        for task in self.tasks.values():
+            task.cancel()
+        self.pool.clear()
+        # calculations check their stop event often, native ones in separate
+        # processes are terminated; the wait is bounded all the same
+        self.pool.waitForDone(CLOSE_WAIT_MS)
+        super().closeEvent(a0)
+
+    def _set_new_graph(self, graph: graph_io.EdgeGraph):
+        # results of the previous graph are dropped when they arrive,
+        # tasks that have not started yet are not run at all
+        self.generation += 1
+        self.pool.clear()
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
+        self.profiler.reset()
 
-    def _set_new_graph(self, graph):
         self.graph = graph
-        self.view.set_graph(self.graph)
-        ollivier = np.array(rc.calculate_ollivier(self.graph, 0.))
-        oflow = np.array(rc.ricci_flow(self.graph, ollivier, float('inf'), 1))
-        forman = np.array(rc.calculate_forman(self.graph))
-        fflow = np.array(rc.ricci_flow(self.graph, forman, float('inf'), 1))
-        self.view.set_params(
-            ollivier=ollivier,
-            oflow=oflow,
-            forman=forman,
-            fflow=fflow
-        )
-
+        with pyrc.phase('load.key'):
+            self.graph_key = calculators.graph_key(graph)
+        with pyrc.phase('load.view'):
+            self.view.set_graph(self.graph)
+        if self.view.layout_steps is not None:
+            self._start_task('layout', refine_layout, self.view.layout_steps, self.view.layout_key)
+        self._start_cached_task('ollivier', calculators.calc_ollivier, self.graph)
+        self._start_cached_task('forman', calculators.calc_forman, self.graph)
+        for key in ('oflow', 'fflow'):
+            self._set_measure_state(key, 'computing...')
+
+    def _start_task(self, key: str, func, *args):
+        task = Task(self.generation, key, func, *args)
+        task.signals.progress.connect(self._task_progress)
+        task.signals.finished.connect(self._task_finished)
+        task.signals.failed.connect(self._task_failed)
+        self.tasks[key] = task
+        if key in self.measure_buttons:
+            self._set_measure_state(key, 'computing...')
+        self.pool.start(task)
+
+    def _start_cached_task(self, key: str, func, *args):
+        result_key = calculators.result_key(self.graph, self.graph_key, key)
+        self._start_task(key, calculators.cached, self.results, result_key, func, *args)
+
+    def _task_progress(self, generation: int, key: str, result: np.ndarray):
+        if generation != self.generation:
+            return
+        if key == 'layout':
+            self.view.set_coords(result)
 
-app = QApplication(sys.argv)
-window = MainWindow()
-app.exec_()
+    def _task_finished(self, generation: int, key: str, result: np.ndarray):
+        if generation != self.generation:
+            return
+        del self.tasks[key]
+        if key == 'layout':
+            return
+        self._set_measure_state(key, None)
+        self.view.set_params(**{key: result})
+        if key == 'ollivier':
+            self._start_cached_task('oflow', calculators.calc_flow, self.graph, result)
+        elif key == 'forman':
+            self._start_cached_task('fflow', calculators.calc_flow, self.graph, result)
+
+    def _task_failed(self, generation: int, key: str, error: Exception):
+        if generation != self.generation:
+            return
+        del self.tasks[key]
+        if key == 'layout':
+            print('layout refinement failed: %r' % error, file=sys.stderr)
+            return
+        self._set_measure_state(key, 'failed')
+        if key in ('ollivier', 'forman'):
+            self._set_measure_state({'ollivier': 'oflow', 'forman': 'fflow'}[key], 'failed')
+        print('%s calculation failed: %r' % (key, error), file=sys.stderr)
+
+    def _set_measure_state(self, key: str, state: Union[str, None]):
+        button, text = self.measure_buttons[key]
+        button.setText(text if state is None else '%s (%s)' % (text, state))
+
+
+def profiler_from_env() -> Union[pyrc.Profiler, None]:
+    """Profiler for RICCI_PROFILE: 'log' logs events, any other value is a JSON lines file."""
+    target = os.environ.get('RICCI_PROFILE')
+    if not target:
+        return None
+    if target == 'log':
+        logging.basicConfig(level=logging.INFO)
+        return pyrc.Profiler(pyrc.LogCollector())
+    return pyrc.Profiler(pyrc.JsonCollector(target))
+
+
+if __name__ == '__main__':
+    profiler = profiler_from_env()
+    pyrc.set_profiler(profiler)
+    app = QApplication(sys.argv)
+    window = MainWindow(profiler=profiler)
+    app.exec_()
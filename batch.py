@@ -0,0 +1,201 @@
+"""Compute curvatures and flows of many graph files without the GUI.
+
+    python3 batch.py graphs/ 'snapshots/*.txt' -o results -j 8 --timeout 600
+
+Every graph gets <output>/<name>.npz with edge arrays src, dst, weights and
+one edge-aligned array per measure; manifest.json in the output directory
+records the state of every graph, so a rerun skips the graphs already done.
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from multiprocessing.connection import wait
+
+import numpy as np
+
+import calculators
+import graph_io
+import result_cache
+
+MANIFEST = 'manifest.json'
+# files picked from directories given as inputs
+GRAPH_EXTENSIONS = ('.npy', '.npz') + graph_io.EDGE_LIST_EXTENSIONS
+
+
+def find_graphs(inputs) -> list:
+    """Graph files in the given directories, glob patterns and paths, without repeats."""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            found = [os.path.join(item, name) for name in sorted(os.listdir(item))
+                     if os.path.splitext(name)[1].lower() in GRAPH_EXTENSIONS]
+        else:
+            found = sorted(glob.glob(item)) or [item]
+        paths.extend(os.path.abspath(path) for path in found if os.path.isfile(path))
+    return list(dict.fromkeys(paths))
+
+
+def output_name(path: str, used: set) -> str:
+    """Result file name for a graph, made unique among the names in used."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    name, i = stem + '.npz', 1
+    while name in used:
+        name, i = '%s-%d.npz' % (stem, i), i + 1
+    used.add(name)
+    return name
+
+
+def load_manifest(output: str) -> dict:
+    try:
+        with open(os.path.join(output, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'graphs': {}}
+
+
+def save_manifest(output: str, manifest: dict):
+    with result_cache.atomic_write(os.path.join(output, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def source_state(path: str) -> list:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def is_done(entry: dict, path: str, output: str, measures) -> bool:
+    """Whether a manifest entry has the measures of an unchanged graph file."""
+    return (entry.get('status') == 'done'
+            and set(measures) <= set(entry.get('measures', ()))
+            and entry.get('source') == source_state(path)
+            and os.path.exists(os.path.join(output, entry['output'])))
+
+
+def process_graph(path: str, target: str, measures, cache_dir, conn):
+    """Worker process: compute the measures of one graph and save them to target."""
+    try:
+        start = time.perf_counter()
+        graph = graph_io.load_graph(path)
+        cache = result_cache.ResultCache(cache_dir) if cache_dir is not None else None
+        # graphs run in parallel already, their components do not
+        results = calculators.calc_measures(graph, measures, cache, workers=1)
+        with result_cache.atomic_write(target) as f:
+            np.savez_compressed(f, src=graph.vertex_ids(graph.src), dst=graph.vertex_ids(graph.dst),
+                                weights=graph.weights, **results)
+        conn.send({
+            'status': 'done',
+            'vertices': int(graph.n),
+            'edges': int(graph.edge_count),
+            'directed': bool(graph.directed),
+            'measures': list(measures),
+            'seconds': time.perf_counter() - start,
+        })
+    except Exception as e:
+        conn.send({'status': 'failed', 'error': repr(e), 'traceback': traceback.format_exc()})
+    finally:
+        conn.close()
+
+
+def run_batch(paths, output: str, measures=calculators.MEASURES, workers=1,
+              timeout=None, cache_dir=None, resume=True, log=sys.stderr) -> dict:
+    """Process graph files, workers at a time, each in its own process.
+
+    A graph running longer than timeout seconds is killed and marked 'timeout'.
+    With resume=True graphs the manifest lists as done are skipped.
+    Returns the manifest.
+    """
+    os.makedirs(output, exist_ok=True)
+    manifest = load_manifest(output) if resume else {'graphs': {}}
+    entries = manifest['graphs']
+    manifest['measures'] = list(measures)
+    used = {entry['output'] for entry in entries.values()}
+
+    todo = []
+    for path in paths:
+        if path in entries and is_done(entries[path], path, output, measures):
+            continue
+        name = entries[path]['output'] if path in entries else output_name(path, used)
+        entries[path] = {'output': name, 'status': 'pending', 'source': source_state(path)}
+        todo.append(path)
+    save_manifest(output, manifest)
+    print('%d graphs, %d to do' % (len(paths), len(todo)), file=log)
+
+    ctx = multiprocessing.get_context()
+    running = {}  # connection -> (path, process, deadline)
+    todo.reverse()
+    while todo or running:
+        while todo and len(running) < workers:
+            path = todo.pop()
+            receiver, sender = ctx.Pipe(duplex=False)
+            target = os.path.join(output, entries[path]['output'])
+            process = ctx.Process(target=process_graph, args=(path, target, list(measures), cache_dir, sender))
+            process.start()
+            sender.close()
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            running[receiver] = (path, process, deadline)
+            entries[path]['status'] = 'running'
+
+        deadlines = [d for _, _, d in running.values() if d is not None]
+        wait_time = max(0., min(deadlines) - time.monotonic()) if deadlines else None
+        for receiver in wait(list(running), wait_time):
+            path, process, _ = running.pop(receiver)
+            try:
+                result = receiver.recv()
+            except EOFError:
+                result = {'status': 'failed', 'error': 'worker exited with code %s' % process.exitcode}
+            receiver.close()
+            process.join()
+            entries[path].update(result)
+            _report(path, entries[path], log)
+            save_manifest(output, manifest)
+
+        now = time.monotonic()
+        for receiver, (path, process, deadline) in list(running.items()):
+            if deadline is not None and now >= deadline:
+                process.kill()
+                process.join()
+                receiver.close()
+                # the killed worker may have left the file it was writing
+                for tmp in glob.glob(glob.escape(os.path.join(output, entries[path]['output'])) + '.*.tmp'):
+                    os.remove(tmp)
+                del running[receiver]
+                entries[path].update({'status': 'timeout', 'seconds': timeout})
+                _report(path, entries[path], log)
+                save_manifest(output, manifest)
+    return manifest
+
+
+def _report(path: str, entry: dict, log):
+    if entry['status'] == 'done':
+        print('done     %s (%d edges, %.1f s)' % (path, entry['edges'], entry['seconds']), file=log)
+    else:
+        print('%-8s %s %s' % (entry['status'], path, entry.get('error', '')), file=log)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute curvatures and Ricci flows of graph files.')
+    parser.add_argument('inputs', nargs='+', help='graph files, directories or glob patterns')
+    parser.add_argument('-o', '--output', required=True, help='directory for results and the manifest')
+    parser.add_argument('-m', '--measures', nargs='+', choices=calculators.MEASURES,
+                        default=list(calculators.MEASURES), help='measures to compute (default: all)')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help='graphs processed at once (default: number of CPUs)')
+    parser.add_argument('--timeout', type=float, help='seconds after which a graph is given up')
+    parser.add_argument('--cache', help='result cache directory shared with the app')
+    parser.add_argument('--restart', action='store_true', help='ignore the manifest of a previous run')
+    args = parser.parse_args(argv)
+
+    paths = find_graphs(args.inputs)
+    manifest = run_batch(paths, args.output, args.measures, max(1, args.workers), args.timeout,
+                         args.cache, not args.restart)
+    failed = [path for path in paths if manifest['graphs'][path]['status'] != 'done']
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""Time the python and native curvature calculators on families of random graphs.
+
+    python3 benchmark.py -o results.json
+    python3 benchmark.py --sizes 100 1000 --baseline results.json
+
+Every family is generated at every size with a fixed seed. Forman and
+Ollivier curvature come from experiments/ricci_calculators.py and from
+ricci_calculator (when it is installed), a single Ricci flow step from both;
+their results are compared edge by edge. Times are the best of --repeat runs,
+peak memory is measured by tracemalloc in a separate run and covers python
+and NumPy allocations only, not the memory ricci_calculator allocates itself.
+With --baseline, cases slower or larger than the baseline by more than
+--tolerance are reported as regressions and the exit code is 1.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import networkx as nx
+import numpy as np
+
+from experiments import ricci_calculators as pyrc
+
+try:
+    import ricci_calculator as rc
+except ImportError:
+    rc = None
+
+FAMILIES = ('geometric', 'erdos_renyi', 'barabasi_albert', 'grid')
+SIZES = (100, 300, 1000)
+# results of the two backends closer than this are equal
+ATOL = 1e-6
+# differences below these are noise, not regressions
+MIN_SECONDS = 1e-3
+MIN_BYTES = 2**20
+
+
+def make_graph(family: str, n: int, seed=0) -> nx.Graph:
+    """Graph of about n vertices and average degree about 4, labelled 0 .. n-1."""
+    if family == 'geometric':
+        # the density of MainWindow.random_graph, 116 vertices with radius 0.1
+        gr = nx.random_geometric_graph(n, 0.1 * np.sqrt(116 / n), seed=seed)
+    elif family == 'erdos_renyi':
+        gr = nx.gnp_random_graph(n, 4 / n, seed=seed)
+    elif family == 'barabasi_albert':
+        gr = nx.barabasi_albert_graph(n, 2, seed=seed)
+    elif family == 'grid':
+        side = int(round(np.sqrt(n)))
+        gr = nx.convert_node_labels_to_integers(nx.grid_2d_graph(side, side))
+    else:
+        raise ValueError('unknown graph family: %r' % family)
+    nx.set_edge_attributes(gr, 1., 'weight')
+    nx.set_node_attributes(gr, 1., 'weight')
+    return gr
+
+
+def measure(func, repeat: int):
+    """Best time of repeat calls, peak traced memory of one more, and the result."""
+    seconds = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak, result
+
+
+def cases(gr: nx.Graph):
+    """(backend, measure, function) triples for a graph; results are edge-aligned."""
+    src, dst = np.array(list(gr.edges()), dtype=np.int64).reshape(-1, 2).T
+    weights = np.ones(len(src))
+    py = {}
+
+    def py_ollivier():
+        py['ollivier'] = pyrc.ollivier(gr.copy(), fix=False, write=False)
+        return py['ollivier']
+
+    def py_forman():
+        return pyrc.forman(gr.copy(), fix=False, write=False)
+
+    def py_flow():
+        return pyrc.flow_step(weights, py['ollivier'], total=weights.sum())
+
+    yield 'python', 'ollivier', py_ollivier
+    yield 'python', 'forman', py_forman
+    yield 'python', 'flow', py_flow
+    if rc is None:
+        return
+
+    mat = nx.to_numpy_array(gr, nodelist=range(gr.number_of_nodes()))
+    native = {}
+
+    def rc_ollivier():
+        native['ollivier'] = np.array(rc.calculate_ollivier(mat, 0.))
+        return native['ollivier'][src, dst]
+
+    def rc_forman():
+        return np.array(rc.calculate_forman(mat))[src, dst]
+
+    def rc_flow():
+        return np.array(rc.ricci_flow(mat, native['ollivier'], float('inf'), 1))[src, dst]
+
+    yield 'rc', 'ollivier', rc_ollivier
+    yield 'rc', 'forman', rc_forman
+    yield 'rc', 'flow', rc_flow
+
+
+def run(families=FAMILIES, sizes=SIZES, repeat=3, log=sys.stderr) -> dict:
+    results, checks = [], []
+    for family in families:
+        for n in sizes:
+            gr = make_graph(family, n)
+            values = {}
+            for backend, name, func in cases(gr):
+                seconds, peak, values[backend, name] = measure(func, repeat)
+                results.append({
+                    'family': family, 'vertices': gr.number_of_nodes(), 'edges': gr.number_of_edges(),
+                    'backend': backend, 'measure': name, 'seconds': seconds, 'peak_bytes': peak,
+                })
+                print('%-16s %6d %-7s %-9s %10.4f s %10.1f MiB'
+                      % (family, gr.number_of_nodes(), backend, name, seconds, peak / 2**20), file=log)
+            for name in ('ollivier', 'forman', 'flow'):
+                if ('rc', name) in values:
+                    diff = np.abs(values['python', name] - values['rc', name]).max(initial=0)
+                    checks.append({'family': family, 'vertices': gr.number_of_nodes(), 'measure': name,
+                                   'max_difference': float(diff), 'equal': bool(diff <= ATOL)})
+    return {
+        'platform': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'rc': rc is not None,
+        },
+        'results': results,
+        'checks': checks,
+    }
+
+
+def regressions(report: dict, baseline: dict, tolerance: float) -> list:
+    """Cases of report slower or using more memory than in baseline by more than tolerance."""
+    def case(r):
+        return r['family'], r['vertices'], r['backend'], r['measure']
+
+    old = {case(r): r for r in baseline['results']}
+    found = []
+    for r in report['results']:
+        if case(r) not in old:
+            continue
+        b = old[case(r)]
+        for field, floor in (('seconds', MIN_SECONDS), ('peak_bytes', MIN_BYTES)):
+            if r[field] > b[field] * (1 + tolerance) and r[field] - b[field] > floor:
+                found.append(dict(zip(('family', 'vertices', 'backend', 'measure'), case(r)),
+                                  field=field, baseline=b[field], value=r[field]))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark curvature calculators.')
+    parser.add_argument('--families', nargs='+', choices=FAMILIES, default=list(FAMILIES))
+    parser.add_argument('--sizes', nargs='+', type=int, default=list(SIZES), help='numbers of vertices')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of every case')
+    parser.add_argument('-o', '--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=.2, help='allowed relative slowdown')
+    args = parser.parse_args(argv)
+
+    if rc is None:
+        print('ricci_calculator is not installed, timing the python backend only', file=sys.stderr)
+    report = run(args.families, args.sizes, max(1, args.repeat))
+    status = 0
+    for check in report['checks']:
+        if not check['equal']:
+            print('backends differ: %(family)s %(vertices)d %(measure)s by %(max_difference).3g' % check,
+                  file=sys.stderr)
+            status = 1
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            report['regressions'] = regressions(report, json.load(f), args.tolerance)
+        for r in report['regressions']:
+            print('regression: %(family)s %(vertices)d %(backend)s %(measure)s %(field)s '
+                  '%(baseline).4g -> %(value).4g' % r, file=sys.stderr)
+            status = 1
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,218 @@
+import multiprocessing
+import os
+from typing import Union
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+import graph_io
+import result_cache
+from experiments import ricci_calculators as pyrc
+
+try:
+    import ricci_calculator as rc
+except ImportError:
+    rc = None
+
+# measures shown by the app, with the curvature each flow starts from
+MEASURES = ('ollivier', 'oflow', 'forman', 'fflow')
+FLOW_CURVATURE = {'oflow': 'ollivier', 'fflow': 'forman'}
+# components with fewer vertices are computed together, packed into groups
+# of about COMPONENT_GROUP_NODES vertices
+SMALL_COMPONENT_NODES = 32
+COMPONENT_GROUP_NODES = 512
+# graphs with fewer edges are not worth starting worker processes for,
+# which take seconds to import the calculators
+POOL_MIN_EDGES = 20000
+# dense graphs with this many vertices go to ricci_calculator in a separate
+# process when their thread can be stopped, see _native
+NATIVE_PROCESS_NODES = 1000
+
+
+# graphs loaded as dense matrices go to ricci_calculator, edge lists
+# to the sparse python calculators; edge_values aligns both with the edges
+
+def calc_ollivier(graph: graph_io.EdgeGraph, workers=os.cpu_count()) -> np.ndarray:
+    return calc_components(graph, _ollivier, workers)
+
+
+def calc_forman(graph: graph_io.EdgeGraph) -> np.ndarray:
+    # linear in the edges, never worth worker processes
+    return calc_components(graph, _forman, workers=1)
+
+
+def _ollivier(graph: graph_io.EdgeGraph) -> np.ndarray:
+    if graph.matrix is not None:
+        return _native('calculate_ollivier', graph.matrix, 0.)
+    return pyrc.ollivier_edges(graph.n, graph.src, graph.dst, graph.weights, 0., graph.directed)
+
+
+def _forman(graph: graph_io.EdgeGraph) -> np.ndarray:
+    if graph.matrix is not None:
+        return _native('calculate_forman', graph.matrix)
+    return pyrc.forman_edges(graph.n, graph.src, graph.dst, graph.weights, directed=graph.directed)
+
+
+def calc_flow(graph: graph_io.EdgeGraph, curvature: np.ndarray) -> np.ndarray:
+    if graph.matrix is not None:
+        return _native('ricci_flow', graph.matrix, np.array(curvature), float('inf'), 1)
+    return pyrc.flow_step(graph.weights, curvature, total=graph.weights.sum())
+
+
+def _native(name: str, matrix, *args) -> np.ndarray:
+    """Result of ricci_calculator.<name>(matrix, *args) as an array.
+
+    The native code never checks pyrc.check_stop, so large graphs are computed
+    in a spawned process that is terminated when the thread's stop event
+    (see pyrc.stop_on) is set.
+    """
+    if rc is None:
+        raise ImportError('ricci_calculator is not installed, it is needed for graphs '
+                          'loaded as dense matrices; load them as edge lists instead')
+    if pyrc.stop_event() is None or len(matrix) < NATIVE_PROCESS_NODES:
+        return _call_native(name, matrix, *args)
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pyrc.wait_results([pool.apply_async(_call_native, (name, matrix) + args)])[0]
+
+
+def _call_native(name: str, *args) -> np.ndarray:
+    return np.array(getattr(rc, name)(*args))
+
+
+def split_components(graph: graph_io.EdgeGraph) -> list:
+    """Vertex and edge indices of the (weakly) connected components, largest first.
+
+    Components of SMALL_COMPONENT_NODES vertices or more come one by one, smaller
+    ones packed together; vertices without edges are left out. Both index
+    arrays of every group are sorted.
+    """
+    with pyrc.phase('components.split'):
+        adj = sp.csr_array((np.ones(graph.edge_count), (graph.src, graph.dst)), shape=(graph.n, graph.n))
+        count, labels = connected_components(adj, directed=graph.directed, connection='weak')
+        sizes = np.bincount(labels, minlength=count)
+        edge_labels = labels[graph.src]
+        order = np.argsort(-sizes, kind='stable')
+        order = order[np.bincount(edge_labels, minlength=count)[order] > 0]
+
+        node_order = np.argsort(labels, kind='stable')
+        node_starts = np.concatenate([[0], np.cumsum(sizes)])
+        edge_order = np.argsort(edge_labels, kind='stable')
+        edge_starts = np.concatenate([[0], np.cumsum(np.bincount(edge_labels, minlength=count))])
+
+        groups, packed = [], []
+        for c in order.tolist() + [None]:
+            if c is None or sizes[c] < SMALL_COMPONENT_NODES:
+                if packed and (c is None or sum(sizes[packed]) + sizes[c] > COMPONENT_GROUP_NODES):
+                    groups.append(packed)
+                    packed = []
+                if c is not None:
+                    packed.append(c)
+            else:
+                groups.append([c])
+        pyrc.count('components.groups', len(groups))
+        return [(np.sort(np.concatenate([node_order[node_starts[c]:node_starts[c+1]] for c in group])),
+                 np.sort(np.concatenate([edge_order[edge_starts[c]:edge_starts[c+1]] for c in group])))
+                for group in groups]
+
+
+def subgraph(graph: graph_io.EdgeGraph, nodes: np.ndarray, edges: np.ndarray) -> graph_io.EdgeGraph:
+    """Graph of the given edges, with the sorted vertices nodes renumbered from 0."""
+    matrix = graph.matrix[np.ix_(nodes, nodes)] if graph.matrix is not None else None
+    return graph_io.EdgeGraph(len(nodes), np.searchsorted(nodes, graph.src[edges]),
+                              np.searchsorted(nodes, graph.dst[edges]), graph.weights[edges],
+                              graph.directed, matrix)
+
+
+def calc_components(graph: graph_io.EdgeGraph, func, workers=os.cpu_count()) -> np.ndarray:
+    """Result of a curvature function func(graph), computed component by component.
+
+    Groups of components (see split_components) go to up to workers processes,
+    largest first, if the graph is large enough for that to pay off; their
+    results are put back into an n x n matrix or an edge-aligned array, the
+    shape func returns for the graph.
+    """
+    groups = split_components(graph)
+    if len(groups) == 1 and len(groups[0][0]) == graph.n:
+        return func(graph)
+
+    if graph.matrix is not None:
+        result = np.zeros((graph.n, graph.n))
+    else:
+        result = np.zeros(graph.edge_count)
+
+    def put(nodes, edges, part):
+        if graph.matrix is not None:
+            result[np.ix_(nodes, nodes)] = part
+        else:
+            result[edges] = part
+
+    if workers is not None and workers > 1 and len(groups) > 1 and graph.edge_count >= POOL_MIN_EDGES:
+        # spawned, since the app calls this from worker threads
+        with multiprocessing.get_context('spawn').Pool(min(workers, len(groups))) as pool:
+            tasks = [pool.apply_async(func, (subgraph(graph, nodes, edges),)) for nodes, edges in groups]
+            for (nodes, edges), part in zip(groups, pyrc.wait_results(tasks)):
+                put(nodes, edges, part)
+    else:
+        for nodes, edges in groups:
+            pyrc.check_stop()
+            put(nodes, edges, func(subgraph(graph, nodes, edges)))
+    return result
+
+
+def edge_values(graph: graph_io.EdgeGraph, result: np.ndarray) -> np.ndarray:
+    """Values of an n x n result at the graph edges; edge-aligned results are kept."""
+    result = np.asarray(result)
+    return result[graph.src, graph.dst] if result.ndim == 2 else result
+
+
+def cached(cache: result_cache.ResultCache, key: str, func, *args) -> np.ndarray:
+    """Result of func(*args) from the cache, computed and stored if it is not there."""
+    result = cache.get(key)
+    if result is None:
+        result = func(*args)
+        cache.put(key, result)
+    return result
+
+
+def graph_key(graph: graph_io.EdgeGraph) -> str:
+    if graph.matrix is not None:
+        return result_cache.content_key(np.asarray(graph.matrix))
+    return result_cache.content_key(
+        graph.n, np.asarray(graph.src), np.asarray(graph.dst), np.asarray(graph.weights), graph.directed)
+
+
+def result_key(graph: graph_io.EdgeGraph, key: str, measure: str) -> str:
+    """Cache key of a measure of the graph with the given graph_key."""
+    # the backends return results of different shapes; idleness 0 and a single
+    # flow step are fixed
+    backend = 'rc' if graph.matrix is not None else 'python'
+    return result_cache.content_key(key, measure, backend, 0., 1)
+
+
+def calc_measures(graph: graph_io.EdgeGraph, measures=MEASURES,
+                  cache: Union[result_cache.ResultCache, None] = None, workers=os.cpu_count()) -> dict:
+    """Compute the given measures with the curvatures their flows need, edge-aligned.
+
+    workers limits the processes Ollivier curvature of separate components runs in.
+    """
+    key = graph_key(graph) if cache is not None else None
+    results = {}
+
+    def measure(name):
+        if name not in results:
+            if name in FLOW_CURVATURE:
+                func, args = calc_flow, (graph, measure(FLOW_CURVATURE[name]))
+            elif name == 'ollivier':
+                func, args = calc_ollivier, (graph, workers)
+            elif name == 'forman':
+                func, args = calc_forman, (graph,)
+            if cache is not None:
+                results[name] = cached(cache, result_key(graph, key, name), func, *args)
+            else:
+                results[name] = func(*args)
+        return results[name]
+
+    for name in measures:
+        measure(name)
+    return {name: edge_values(graph, results[name]) for name in measures}
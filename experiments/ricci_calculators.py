@@ -1,7 +1,225 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from multiprocessing import Pool, shared_memory
+
 import matplotlib.pyplot as plt
 import networkx as nx
 import numpy as np
 import ot
+import scipy.sparse as sp
+from scipy.sparse.csgraph import dijkstra
+
+# graphs with more nodes get on-demand distances instead of Floyd-Warshall
+DENSE_DISTANCE_NODES = 2000
+# default memory budget of the distance row cache
+DISTANCE_CACHE_BYTES = 256 * 2**20
+# distance rows computed together on the graph of the ball around their sources
+BALL_SOURCES = 64
+# dynamic distance rows reach this much further than needed,
+# so that small weight increases do not invalidate all of them
+DYNAMIC_LIMIT_SLACK = 1.2
+# DynamicDistances looks for the affected rows only while at most this
+# fraction of the weights changes at once (past about 2% on sparse graphs
+# finding them costs more than it saves); otherwise it recomputes all rows
+DYNAMIC_MAX_CHANGED = 0.01
+# default memory budget of the streaming calculators
+STREAM_BYTES = 256 * 2**20
+# approximate memory taken by one loaded neighborhood row while a chunk is computed
+STREAM_ENTRY_BYTES = 96
+# marginal error Sinkhorn stages before the last one stop at
+SINKHORN_STAGE_TOL = 1e-3
+# Sinkhorn scalings divide by at least this
+SINKHORN_TINY = 1e-300
+# seconds between stop checks while waiting for worker processes
+STOP_POLL_SECONDS = 0.1
+
+
+class Profiler:
+    """Named phase timers and counters, passed on to collectors.
+
+    Collectors are callables taking (kind, name, value): kind is 'timer' with
+    the seconds a phase took or 'counter' with an increment. LogCollector and
+    JsonCollector are ready-made ones, any function works as a callback.
+    Totals per name accumulate in totals and counts until reset().
+    """
+
+    def __init__(self, *collectors):
+        self.collectors = list(collectors)
+        self.totals = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.totals[name] = self.totals.get(name, 0.) + seconds
+        for collector in self.collectors:
+            collector('timer', name, seconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+        for collector in self.collectors:
+            collector('counter', name, value)
+
+    def snapshot(self):
+        """Copies of totals and counts, safe to read while other threads run."""
+        with self._lock:
+            return dict(self.totals), dict(self.counts)
+
+    def reset(self):
+        with self._lock:
+            self.totals.clear()
+            self.counts.clear()
+
+
+class LogCollector:
+    """Writes profiling events to a logger."""
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger if logger is not None else logging.getLogger('ricci.profile')
+        self.level = level
+
+    def __call__(self, kind, name, value):
+        if kind == 'timer':
+            self.logger.log(self.level, '%s: %.6f s', name, value)
+        else:
+            self.logger.log(self.level, '%s: +%s', name, value)
+
+
+class JsonCollector:
+    """Appends profiling events to a file as JSON lines."""
+
+    def __init__(self, path):
+        self.file = open(path, 'a', buffering=1)
+        self._lock = threading.Lock()
+
+    def __call__(self, kind, name, value):
+        line = json.dumps({'time': time.time(), 'thread': threading.current_thread().name,
+                           'kind': kind, 'name': name, 'value': value})
+        with self._lock:
+            self.file.write(line + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+# profiler receiving the events of this module and of its users, None if disabled
+_profiler = None
+_no_phase = nullcontext()
+
+
+def set_profiler(profiler):
+    """Install a Profiler, or None to disable profiling; returns the previous one."""
+    global _profiler
+    previous, _profiler = _profiler, profiler
+    return previous
+
+
+def get_profiler():
+    return _profiler
+
+
+def phase(name):
+    """Context manager timing a phase; does nothing while profiling is disabled."""
+    profiler = _profiler
+    return _no_phase if profiler is None else profiler.timer(name)
+
+
+def count(name, value=1):
+    profiler = _profiler
+    if profiler is not None:
+        profiler.count(name, value)
+
+
+class Stopped(Exception):
+    """Raised inside a calculation whose stop event has been set."""
+
+
+# stop event of the calculation running in the current thread
+_stop = threading.local()
+
+
+@contextmanager
+def stop_on(event):
+    """Make the calculations of this thread raise Stopped once the threading.Event is set."""
+    previous = getattr(_stop, 'event', None)
+    _stop.event = event
+    try:
+        yield
+    finally:
+        _stop.event = previous
+
+
+def stop_event():
+    """Stop event installed by stop_on in the current thread, None if there is none."""
+    return getattr(_stop, 'event', None)
+
+
+def check_stop():
+    """Raise Stopped if the calculation of the current thread should stop."""
+    event = getattr(_stop, 'event', None)
+    if event is not None and event.is_set():
+        raise Stopped()
+
+
+def wait_results(results):
+    """Values of multiprocessing AsyncResults, checking check_stop while waiting.
+
+    Leaving the with block of their pool on Stopped terminates the workers.
+    """
+    for result in results:
+        while not result.ready():
+            check_stop()
+            result.wait(STOP_POLL_SECONDS)
+    return [result.get() for result in results]
+
+
+class _Laps:
+    """Splits the time of a loop among phases: a call charges the time since the previous one to name."""
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.spent = {}
+        self.last = time.perf_counter()
+
+    def __call__(self, name):
+        now = time.perf_counter()
+        self.spent[name] = self.spent.get(name, 0.) + now - self.last
+        self.last = now
+
+    def done(self):
+        for name, seconds in self.spent.items():
+            self.profiler.add(name, seconds)
+
+
+class _NoLaps:
+    def __call__(self, name):
+        pass
+
+    def done(self):
+        pass
+
+
+_no_laps = _NoLaps()
+
+
+def _laps():
+    profiler = _profiler
+    return _no_laps if profiler is None else _Laps(profiler)
 
 
 def _fix_graph(gr):
@@ -17,6 +235,76 @@ def _fix_graph(gr):
             gr.nodes[v]['weight'] = 1
 
 
+def _graph_arrays(gr):
+    """Convert graph to CSR adjacency, node weights and edge endpoints.
+
+    Nodes are indexed in gr.nodes() order, edge arrays follow gr.edges() order.
+    """
+    index = {v: i for i, v in enumerate(gr.nodes())}
+    n = len(index)
+    edges = list(gr.edges(data='weight', default=1))
+    src = np.fromiter((index[e[0]] for e in edges), dtype=np.int64, count=len(edges))
+    dst = np.fromiter((index[e[1]] for e in edges), dtype=np.int64, count=len(edges))
+    weights = np.fromiter((e[2] for e in edges), dtype=float, count=len(edges))
+    node_weights = np.fromiter(
+        (w for _, w in gr.nodes(data='weight', default=1)), dtype=float, count=n
+    )
+
+    adj, _ = _edge_csr(n, src, dst, weights, gr.is_directed())
+    return adj, node_weights, src, dst, weights
+
+
+def _edge_csr(n, src, dst, weights, directed):
+    """Build CSR adjacency from edge arrays.
+
+    Also returns the edge index of every stored entry, so adj.data == weights[slots].
+    """
+    ids = np.arange(len(src))
+    if directed:
+        rows, cols = src, dst
+    else:
+        # store both directions, self-loops only once
+        back = src != dst
+        rows = np.concatenate([src, dst[back]])
+        cols = np.concatenate([dst, src[back]])
+        ids = np.concatenate([ids, ids[back]])
+    slots = sp.csr_array((ids, (rows, cols)), shape=(n, n))
+    slots.sort_indices()
+    adj = sp.csr_array((weights[slots.data], slots.indices, slots.indptr), shape=(n, n))
+    return adj, slots.data
+
+
+def _write_edges(gr, attr, values):
+    """Write edge-aligned values to the given edge attribute."""
+    for e, val in zip(gr.edges(), values.tolist()):
+        gr.edges[e][attr] = val
+
+
+def forman_csr(adj, node_weights, src, dst, weights):
+    """Calculate Forman-Ricci curvature of edges (src, dst) with one batch of array operations."""
+    if len(src) == 0:
+        return np.zeros(0)
+    # sum of 1/sqrt(w) over the outgoing edges of every node
+    inv_sqrt = adj.copy()
+    inv_sqrt.data = 1 / np.sqrt(inv_sqrt.data)
+    inv_sum = np.asarray(inv_sqrt.sum(axis=1)).ravel()
+
+    # the edge itself is excluded from both endpoint sums; for directed
+    # graphs the reverse edge may be missing or have its own weight
+    fwd = 1 / np.sqrt(weights)
+    # SciPy indexing fails on read-only index arrays, such as unpickled ones
+    back = np.asarray(adj[np.array(dst), np.array(src)]).ravel()
+    back = np.divide(1, np.sqrt(back), out=np.zeros_like(back), where=back != 0)
+
+    wv1 = node_weights[src]
+    wv2 = node_weights[dst]
+    f = (wv1+wv2) / weights
+    f -= wv1 * fwd * (inv_sum[src] - fwd)
+    f -= wv2 * fwd * (inv_sum[dst] - back)
+    f *= weights
+    return f
+
+
 def _forman_edge(gr, edge):
     """Calculate Forman-Ricci curvature for one exact edge."""
     v1, v2 = edge
@@ -36,6 +324,281 @@ def _forman_edge(gr, edge):
     return f
 
 
+class DenseDistances:
+    """Distances looked up in a full n x n matrix."""
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    def submatrix(self, rows, cols):
+        return self.matrix[np.ix_(rows, cols)]
+
+    def submatrices(self, rows, cols):
+        return self.matrix[rows[:, :, None], cols[:, None, :]]
+
+
+class ShortestPaths:
+    """Distances computed on demand with truncated Dijkstra over a CSR adjacency.
+
+    Distance rows are stored sparsely (only targets within limit) in an LRU
+    cache holding at most max_bytes. Distances above limit are reported as inf.
+    With a finite limit, Dijkstra runs on the ball of nodes within limit of a
+    few sources at a time, so a row costs time in the size of that ball and
+    not of the graph.
+    """
+
+    # keep the shortest path tree of every row, for DynamicDistances
+    predecessors = False
+
+    def __init__(self, adj, limit=np.inf, max_bytes=DISTANCE_CACHE_BYTES):
+        self.adj = adj
+        self.limit = limit
+        self.max_bytes = max_bytes
+        self._rows = OrderedDict()
+        self._bytes = 0
+
+    def rows(self, sources):
+        """Return (targets, distances) pairs for every source, computing missing ones.
+
+        With predecessors the tuples have a third array, the predecessor of
+        every target on its shortest path.
+        """
+        sources = sources.tolist()
+        found = {}
+        for s in sources:
+            if s in self._rows:
+                self._rows.move_to_end(s)
+                found[s] = self._rows[s]
+
+        missing = [s for s in dict.fromkeys(sources) if s not in found]
+        if missing:
+            count('distances.rows', len(missing))
+        # Dijkstra returns dense rows, as many of them as fit into the budget
+        chunk = max(1, min(BALL_SOURCES, self.max_bytes // (16 * max(1, self.adj.shape[0]))))
+        for start in range(0, len(missing), chunk):
+            check_stop()
+            part = missing[start:start+chunk]
+            with phase('distances.ball'):
+                nodes, adj, indices = self._ball(np.array(part))
+            with phase('distances.dijkstra'):
+                result = dijkstra(adj, indices=indices, limit=self.limit,
+                                  return_predecessors=self.predecessors)
+            dist, pred = result if self.predecessors else (result, None)
+            for i, s in enumerate(part):
+                local = np.flatnonzero(np.isfinite(dist[i]))
+                found[s] = (local if nodes is None else nodes[local], dist[i][local])
+                if pred is not None:
+                    # the source itself has a negative predecessor
+                    p = pred[i][local]
+                    found[s] += (p if nodes is None else np.where(p >= 0, nodes[np.maximum(p, 0)], p),)
+                self._store(s, found[s])
+        return [found[s] for s in sources]
+
+    def _ball(self, sources):
+        """Nodes within limit of sources, their adjacency and the sources' indices
+        in it; nodes is None and the adjacency the whole graph if the limit is
+        infinite or the ball holds half of the graph's entries."""
+        if np.isfinite(self.limit):
+            ball = _ball(_CsrRows(self.adj), np.unique(sources), self.limit, self.adj.nnz // 2)
+            if ball is not None:
+                nodes, rows, cols, weights, _ = ball
+                return nodes, _local_csr(nodes, rows, cols, weights), np.searchsorted(nodes, sources)
+        return None, self.adj, sources
+
+    def submatrix(self, rows, cols):
+        cost = np.empty((len(rows), len(cols)))
+        for i, (targets, dists, *_) in enumerate(self.rows(rows)):
+            pos = np.minimum(np.searchsorted(targets, cols), len(targets)-1)
+            cost[i] = np.where(targets[pos] == cols, dists[pos], np.inf)
+        return cost
+
+    def submatrices(self, rows, cols):
+        """Stack of submatrix(rows[k], cols[k]) for 2-D rows and cols, looked up all at once."""
+        n = self.adj.shape[0]
+        sources = np.unique(rows)
+        found = self.rows(sources)
+        # (row, target) keys of all entries, sorted as the sources and their targets are
+        keys = np.concatenate([k * n + row[0] for k, row in enumerate(found)])
+        dists = np.concatenate([row[1] for row in found])
+        wanted = np.searchsorted(sources, rows)[:, :, None] * n + cols[:, None, :]
+        pos = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+        return np.where(keys[pos] == wanted, dists[pos], np.inf)
+
+    def clear(self):
+        self._rows.clear()
+        self._bytes = 0
+
+    def forget(self, sources):
+        """Drop cached rows of the given sources."""
+        for s in sources.tolist():
+            if s in self._rows:
+                self._drop(s)
+
+    def _store(self, source, row):
+        self._rows[source] = row
+        self._bytes += sum(a.nbytes for a in row)
+        while self._bytes > self.max_bytes and len(self._rows) > 1:
+            self._drop(next(iter(self._rows)))
+
+    def _drop(self, source):
+        self._bytes -= sum(a.nbytes for a in self._rows.pop(source))
+
+
+class DynamicDistances(ShortestPaths):
+    """ShortestPaths kept exact across changes of edge weights, as in Ricci flow.
+
+    Rows keep the predecessors of their shortest path trees. update() takes
+    new weights and recomputes only the cached rows they change: those whose
+    tree uses an edge that got longer and those in which an edge that got
+    shorter gives a shorter path. Rows reach slack times further than limit;
+    when update() asks for more than that, or more than DYNAMIC_MAX_CHANGED
+    of the weights change, all of them are recomputed. verify() compares the
+    cached rows with a full recompute.
+
+    A reverse index from nodes to the rows reaching them is kept up to date
+    as rows are stored and dropped: a target-sorted part, merged again only
+    once the entries added since are a quarter of its size, and those added
+    entries. Entries of rows dropped or recomputed since are recognized by
+    the version of their row and skipped.
+    """
+
+    predecessors = True
+
+    def __init__(self, adj, limit=np.inf, max_bytes=DISTANCE_CACHE_BYTES, slack=DYNAMIC_LIMIT_SLACK):
+        # the caller may change adj in place, and update() compares with the old weights
+        super().__init__(adj.copy(), limit * slack, max_bytes)
+        self.slack = slack
+        self._version = np.zeros(adj.shape[0], dtype=np.int64)
+        # (target, source, version) arrays of the index, sorted and added
+        self._index = tuple(np.zeros(0, dtype=np.int64) for _ in range(3))
+        self._added = []
+        self._added_count = 0
+
+    def update(self, data, limit=None):
+        """Set new weights of the adjacency entries, in adj.data order.
+
+        limit is the distance rows must reach from now on. Returns the sources
+        of the recomputed rows.
+        """
+        old = self.adj.data
+        self.adj = sp.csr_array((np.array(data, dtype=float), self.adj.indices, self.adj.indptr),
+                                shape=self.adj.shape)
+        changed = np.flatnonzero(self.adj.data != old)
+        if limit is not None and limit > self.limit:
+            self.limit = limit * self.slack
+            affected = np.fromiter(self._rows, dtype=np.int64, count=len(self._rows))
+        elif len(changed) == 0 or not self._rows:
+            return np.zeros(0, dtype=np.int64)
+        elif len(changed) > DYNAMIC_MAX_CHANGED * len(old):
+            affected = np.fromiter(self._rows, dtype=np.int64, count=len(self._rows))
+        else:
+            with phase('distances.update'):
+                tails = np.repeat(np.arange(self.adj.shape[0]), np.diff(self.adj.indptr))[changed]
+                affected = self._affected(tails, self.adj.indices[changed], self.adj.data[changed],
+                                          self.adj.data[changed] > old[changed])
+        count('distances.updated_rows', len(affected))
+        self.forget(affected)
+        # the next flow iteration asks for the same rows
+        self.rows(affected)
+        return affected
+
+    def verify(self, sources=None):
+        """Largest difference of the cached rows (of sources, by default all)
+        from rows computed from scratch; inf if they reach different targets."""
+        if sources is None:
+            sources = list(self._rows)
+        else:
+            sources = [s for s in np.asarray(sources).tolist() if s in self._rows]
+        fresh = ShortestPaths(self.adj, self.limit, self.max_bytes)
+        error = 0.
+        chunk = max(1, self.max_bytes // (16 * max(1, self.adj.shape[0])))
+        for start in range(0, len(sources), chunk):
+            part = sources[start:start+chunk]
+            for s, (targets, dists) in zip(part, fresh.rows(np.array(part))):
+                cached_targets, cached_dists = self._rows[s][:2]
+                if not np.array_equal(targets, cached_targets):
+                    return np.inf
+                error = max(error, np.abs(dists - cached_dists).max(initial=0))
+            fresh.clear()
+        return error
+
+    def clear(self):
+        super().clear()
+        self._version += 1
+        self._index = tuple(np.zeros(0, dtype=np.int64) for _ in range(3))
+        self._added = []
+        self._added_count = 0
+
+    def _store(self, source, row):
+        self._version[source] += 1
+        self._added.append((row[0], np.full(len(row[0]), source), np.full(len(row[0]), self._version[source])))
+        self._added_count += len(row[0])
+        super()._store(source, row)
+
+    def _drop(self, source):
+        self._version[source] += 1
+        super()._drop(source)
+
+    def _reaching(self, nodes):
+        """Pairs (k, source) of cached rows reaching nodes[k], as two arrays."""
+        if self._added_count > len(self._index[0]) // 4:
+            # merge the added entries into the sorted ones, leaving out stale ones
+            merged = [np.concatenate(arrays) for arrays in zip(self._index, *self._added)]
+            live = merged[2] == self._version[merged[1]]
+            order = np.argsort(merged[0][live], kind='stable')
+            self._index = tuple(a[live][order] for a in merged)
+            self._added = []
+            self._added_count = 0
+
+        targets, sources, versions = self._index
+        unique = np.unique(nodes)
+        first = np.searchsorted(targets, unique)
+        entries = _ranges(first, np.searchsorted(targets, unique, side='right') - first)
+        found = [targets[entries], sources[entries], versions[entries]]
+        if self._added:
+            added = [np.concatenate(arrays) for arrays in zip(*self._added)]
+            self._added = [tuple(added)]
+            hit = np.isin(added[0], unique)
+            found = [np.concatenate([a, b[hit]]) for a, b in zip(found, added)]
+        live = found[2] == self._version[found[1]]
+        targets, sources = found[0][live], found[1][live]
+
+        # pair every entry with the positions of its target in nodes
+        order = np.argsort(nodes, kind='stable')
+        first = np.searchsorted(nodes[order], targets)
+        counts = np.searchsorted(nodes[order], targets, side='right') - first
+        return order[_ranges(first, counts)], np.repeat(sources, counts)
+
+    def _affected(self, tails, heads, weights, longer):
+        """Sources of cached rows changed by new weights of the edges tails -> heads.
+
+        An edge matters to a row only if the row reaches its tail.
+        """
+        edge, sources = self._reaching(tails)
+        if not len(edge):
+            return np.zeros(0, dtype=np.int64)
+        n = self.adj.shape[0]
+        involved, row = np.unique(sources, return_inverse=True)
+        rows = [self._rows[s] for s in involved.tolist()]
+        keys = np.concatenate([k * n + r[0] for k, r in enumerate(rows)])
+        dists = np.concatenate([r[1] for r in rows])
+        preds = np.concatenate([r[2] for r in rows])
+
+        via = dists[np.searchsorted(keys, row * n + tails[edge])] + weights[edge]
+        head_keys = row * n + heads[edge]
+        pos = np.minimum(np.searchsorted(keys, head_keys), len(keys) - 1)
+        reached = keys[pos] == head_keys
+        hit = np.where(longer[edge],
+                       reached & (preds[pos] == tails[edge]),
+                       (via < np.where(reached, dists[pos], np.inf)) & (via <= self.limit))
+        return involved[np.unique(row[hit])]
+
+
+def _ranges(starts, counts):
+    """Concatenated ranges starts[k]:starts[k]+counts[k] as one index array."""
+    return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+
 def _create_mu(vertex, gr, idleness):
     """Calculate mu; used in Ollivier calculations."""
     neighborlist = list(gr.neighbors(vertex))
@@ -45,6 +608,413 @@ def _create_mu(vertex, gr, idleness):
     return mu
 
 
+def _local_mu(adj, vertex, idleness):
+    """Calculate mu on its support only (neighbors, then the vertex itself); used in Ollivier calculations."""
+    neighbors = adj.indices[adj.indptr[vertex]:adj.indptr[vertex+1]]
+    spread = (1-idleness) / len(neighbors)
+    support = np.append(neighbors[neighbors != vertex], vertex)
+    mu = np.full(len(support), spread)
+    mu[-1] = idleness
+    return support, mu
+
+
+def ollivier_csr(adj, src, dst, weights, idleness, distances):
+    """Calculate Ollivier-Ricci curvature of edges (src, dst).
+
+    Every transport problem is built over supp(mu1) x supp(mu2) only,
+    so its size depends on the endpoint degrees and not on the graph size.
+    """
+    curvature = np.empty(len(src))
+    lap = _laps()
+    for k, (v1, v2) in enumerate(zip(src.tolist(), dst.tolist())):
+        check_stop()
+        support1, mu1 = _local_mu(adj, v1, idleness)
+        support2, mu2 = _local_mu(adj, v2, idleness)
+        lap('ollivier.mu')
+        cost = distances.submatrix(support1, support2)
+        lap('ollivier.cost')
+        curvature[k] = 1 - ot.emd2(mu1, mu2, cost)/weights[k]
+        lap('ollivier.emd')
+    lap.done()
+    count('ollivier.emd_calls', len(src))
+    return curvature
+
+
+def _local_mu_batch(adj, vertices, idleness, width):
+    """Calculate _local_mu of many vertices at once, padded with zero mass to width."""
+    deg = np.diff(adj.indptr)[vertices]
+    offsets = np.arange(width-1)
+    valid = offsets < deg[:, None]
+    pos = np.where(valid, adj.indptr[vertices][:, None] + offsets, 0)
+    neighbors = np.where(valid, adj.indices[pos], 0)
+    spread = np.where(valid & (neighbors != vertices[:, None]), ((1-idleness) / deg)[:, None], 0.)
+    support = np.column_stack([neighbors, vertices])
+    mu = np.column_stack([spread, np.full(len(vertices), float(idleness))])
+    return support, mu
+
+
+def _rounded_cost(plan, mu1, mu2, cost):
+    """Costs of a batch of plans rounded to the exact marginals mu1 and mu2.
+
+    Rows and columns are scaled down to their marginals, then the missing mass
+    is spread; the rounded plans are feasible, so their costs are never below
+    the optimal ones.
+    """
+    rows = plan.sum(axis=2)
+    plan = plan * np.divide(mu1, rows, out=np.ones_like(mu1), where=rows > mu1)[:, :, None]
+    cols = plan.sum(axis=1)
+    plan *= np.divide(mu2, cols, out=np.ones_like(mu2), where=cols > mu2)[:, None, :]
+    missing1 = mu1 - plan.sum(axis=2)
+    missing2 = mu2 - plan.sum(axis=1)
+    total = missing1.sum(axis=1)
+    plan += np.divide(missing1, total[:, None], out=np.zeros_like(mu1),
+                      where=total[:, None] > 0)[:, :, None] * missing2[:, None, :]
+    return (plan * cost).sum(axis=(1, 2))
+
+
+def _dual_bound(f, mu1, mu2, cost):
+    """Lower bounds on the optimal costs of a batch of transport problems from
+    the potentials f of their sources, completed by their c-transform."""
+    g = np.where(mu1[:, :, None] > 0, cost - f[:, :, None], np.inf).min(axis=1)
+    return (np.where(mu1 > 0, f, 0.) * mu1).sum(axis=1) + (np.where(mu2 > 0, g, 0.) * mu2).sum(axis=1)
+
+
+def _sinkhorn_batch(mu1, mu2, cost, eps, tol, max_iter):
+    """Solve a batch of entropic transport problems, return upper and lower
+    bounds on their optimal transport costs.
+
+    Uses Sinkhorn scaling with eps annealing: the regularization goes down
+    4 times per stage and the potentials are absorbed into the kernel after
+    every stage, so the scalings stay close to 1. Every stage runs up to
+    max_iter iterations, the ones before the last only to a marginal error
+    of SINKHORN_STAGE_TOL; the last one also stops a problem once its bounds
+    are eps apart. The cost of the final plan rounded to the exact marginals
+    is the upper bound, the final potentials give the lower one. Problems
+    are dropped from the iterations as they converge.
+    """
+    # padding and zero-mass entries must not produce inf - inf
+    cost = np.where((mu1[:, :, None] > 0) & (mu2[:, None, :] > 0), cost, 0.)
+    stages = max(1, int(np.ceil(np.log(max(cost.max(), eps) / eps) / np.log(4))) + 1)
+    f = np.zeros_like(mu1)
+    g = np.zeros_like(mu2)
+    for stage in range(stages):
+        stage_eps = eps * 4 ** (stages-1 - stage)
+        stage_tol = tol if stage == stages-1 else max(tol, SINKHORN_STAGE_TOL)
+        kernel = np.exp((f[:, :, None] + g[:, None, :] - cost) / stage_eps)
+        u = np.ones_like(mu1)
+        v = np.ones_like(mu2)
+        # problems still iterated, with their kernels, marginals and scalings
+        active = np.arange(len(mu1))
+        part = kernel, mu1, mu2, u, v, cost, f
+        for i in range(max_iter):
+            part_kernel, part_mu1, part_mu2, part_u, part_v, part_cost, part_f = part
+            kv = (part_kernel @ part_v[:, :, None])[:, :, 0]
+            # column marginals are exact after the v step, check the rows
+            if i % 10 == 9:
+                done = np.abs(part_u * kv - part_mu1).max(axis=1) < stage_tol
+                if stage == stages-1:
+                    # the last stage also stops once the bounds are eps apart
+                    with np.errstate(divide='ignore'):
+                        gap = (_rounded_cost(part_u[:, :, None] * part_kernel * part_v[:, None, :],
+                                             part_mu1, part_mu2, part_cost)
+                               - _dual_bound(part_f + stage_eps * np.log(part_u), part_mu1, part_mu2, part_cost))
+                    done |= gap <= eps
+                if done.any():
+                    u[active[done]] = part_u[done]
+                    v[active[done]] = part_v[done]
+                    active = active[~done]
+                    part = tuple(a[~done] for a in part)
+                    if not len(active):
+                        break
+                    part_kernel, part_mu1, part_mu2, part_u, part_v, part_cost, part_f = part
+                    kv = kv[~done]
+            # rows and columns without mass have zero kernels after the first stage
+            part_u = part_mu1 / np.maximum(kv, SINKHORN_TINY)
+            ku = (part_u[:, None, :] @ part_kernel)[:, 0, :]
+            part_v = part_mu2 / np.maximum(ku, SINKHORN_TINY)
+            part = part_kernel, part_mu1, part_mu2, part_u, part_v, part_cost, part_f
+        u[active] = part[3]
+        v[active] = part[4]
+        if stage < stages-1:
+            with np.errstate(divide='ignore'):
+                f += stage_eps * np.log(u)
+                g += stage_eps * np.log(v)
+
+    upper = _rounded_cost(u[:, :, None] * kernel * v[:, None, :], mu1, mu2, cost)
+    with np.errstate(divide='ignore'):
+        f += stage_eps * np.log(u)
+    return upper, _dual_bound(f, mu1, mu2, cost)
+
+
+def ollivier_sinkhorn(adj, src, dst, weights, idleness, distances,
+                      eps=0.01, tol=1e-6, max_iter=500, batch_bytes=64 * 2**20):
+    """Approximate ollivier_csr with entropy-regularized transport (Sinkhorn).
+
+    Edges are grouped by endpoint degrees rounded up to powers of two; every
+    group is padded to a common support size and solved as one batch of
+    NumPy operations using at most about batch_bytes per array.
+    Costs are measured in units of the edge weight, so eps, the regularization,
+    is in curvature units. Every result is at most eps below the exact
+    curvature and never above it: edges whose Sinkhorn bounds are further
+    apart are solved exactly with ollivier_csr. tol is the marginal error the
+    iterations stop at, max_iter their limit per annealing stage.
+    """
+    curvature = np.empty(len(src))
+    deg = np.diff(adj.indptr)
+    width1 = 2 ** np.ceil(np.log2(deg[src] + 1)).astype(np.int64)
+    width2 = 2 ** np.ceil(np.log2(deg[dst] + 1)).astype(np.int64)
+    for w1, w2 in set(zip(width1.tolist(), width2.tolist())):
+        group = np.flatnonzero((width1 == w1) & (width2 == w2))
+        per_batch = max(1, batch_bytes // (8 * w1 * w2))
+        for start in range(0, len(group), per_batch):
+            check_stop()
+            edges = group[start:start+per_batch]
+            support1, mu1 = _local_mu_batch(adj, src[edges], idleness, w1)
+            support2, mu2 = _local_mu_batch(adj, dst[edges], idleness, w2)
+            cost = distances.submatrices(support1, support2) / weights[edges][:, None, None]
+            upper, lower = _sinkhorn_batch(mu1, mu2, cost, eps, tol, max_iter)
+            curvature[edges] = 1 - upper
+            loose = edges[upper - lower > eps]
+            count('ollivier.sinkhorn_exact', len(loose))
+            curvature[loose] = ollivier_csr(adj, src[loose], dst[loose], weights[loose], idleness, distances)
+    return curvature
+
+
+def _share(arrays):
+    """Copy arrays to shared memory. Returns the blocks by name and a picklable spec to attach to them."""
+    blocks, spec = {}, {}
+    for name, arr in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, arr.dtype, buffer=block.buf)[...] = arr
+        blocks[name] = block
+        spec[name] = (block.name, arr.shape, arr.dtype.str)
+    return blocks, spec
+
+
+def _attach(spec):
+    """Attach to arrays shared by _share. Returns the blocks and the arrays."""
+    blocks, arrays = {}, {}
+    for name, (block_name, shape, dtype) in spec.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks[name] = block
+        arrays[name] = np.ndarray(shape, dtype, buffer=block.buf)
+    return blocks, arrays
+
+
+# per-process state of Ollivier pool workers
+_worker = {}
+
+
+def _ollivier_worker_init(spec, idleness, limit, max_bytes):
+    blocks, arrays = _attach(spec)
+    n = len(arrays['indptr']) - 1
+    adj = sp.csr_array((arrays['data'], arrays['indices'], arrays['indptr']), shape=(n, n))
+    if 'distances' in arrays:
+        distances = DenseDistances(arrays['distances'])
+    else:
+        distances = ShortestPaths(adj, limit, max_bytes)
+    _worker.update(blocks=blocks, arrays=arrays, adj=adj, distances=distances, idleness=idleness)
+
+
+def _ollivier_worker_run(start, stop):
+    arrays = _worker['arrays']
+    arrays['out'][start:stop] = ollivier_csr(
+        _worker['adj'],
+        arrays['src'][start:stop],
+        arrays['dst'][start:stop],
+        arrays['weights'][start:stop],
+        _worker['idleness'],
+        _worker['distances']
+    )
+
+
+def ollivier_pool(adj, src, dst, weights, idleness, distances, workers):
+    """Calculate ollivier_csr on a process pool.
+
+    The adjacency, edges and dense distances (if any) are passed to the
+    workers through shared memory; ShortestPaths providers are recreated in
+    every worker with the same limit and memory budget. Edges are split into
+    contiguous chunks, results are returned in edge order.
+    """
+    arrays = {
+        'indptr': adj.indptr, 'indices': adj.indices, 'data': adj.data,
+        'src': src, 'dst': dst, 'weights': weights,
+        'out': np.empty(len(src)),
+    }
+    limit, max_bytes = np.inf, DISTANCE_CACHE_BYTES
+    if isinstance(distances, DenseDistances):
+        arrays['distances'] = distances.matrix
+    else:
+        limit, max_bytes = distances.limit, distances.max_bytes
+
+    # several chunks per worker to even out the load;
+    # chunks are contiguous to keep neighborhoods in the distance caches
+    chunk = max(1, -(-len(src) // (8 * workers)))
+    blocks, spec = _share(arrays)
+    try:
+        with Pool(workers, initializer=_ollivier_worker_init,
+                  initargs=(spec, idleness, limit, max_bytes)) as pool:
+            wait_results([pool.apply_async(_ollivier_worker_run, (start, min(start+chunk, len(src))))
+                          for start in range(0, len(src), chunk)])
+        out = np.ndarray(len(src), buffer=blocks['out'].buf).copy()
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+    return out
+
+
+def _common_neighbors(adj, src, dst, max_bytes=DISTANCE_CACHE_BYTES):
+    """Number of common neighbors of every pair (src[k], dst[k]), self-loops ignored.
+
+    Reads them off rows of A @ A, computed for as many rows at once as fit into
+    about max_bytes.
+    """
+    coo = adj.tocoo()
+    keep = coo.row != coo.col
+    pattern = sp.csr_array((np.ones(keep.sum()), (coo.row[keep], coo.col[keep])), shape=adj.shape)
+    # entries of a row of A @ A are at most the degrees of its neighbors
+    work = np.cumsum(pattern @ np.diff(pattern.indptr).astype(float))
+    order = np.argsort(src, kind='stable')
+    rows, cols = src[order], dst[order]
+    common = np.zeros(len(src))
+    start = 0
+    while start < len(rows):
+        first = rows[start]
+        done = work[first-1] if first > 0 else 0.
+        last = max(first + 1, int(np.searchsorted(work, done + max_bytes / 16, side='right')))
+        stop = int(np.searchsorted(rows, last))
+        square = pattern[first:last] @ pattern
+        common[order[start:stop]] = square[rows[start:stop] - first, cols[start:stop]]
+        start = stop
+    return common
+
+
+def ollivier_bounds(adj, src, dst, weights, idleness):
+    """Lower and upper bounds of the Ollivier-Ricci curvature of edges (src, dst).
+
+    Returns an E x 2 array of lower and upper bounds, computed with array
+    operations from degrees and common neighbors only; the graph must be
+    undirected. Jost and Liu bound the curvature of an idleness 0 walk in the
+    hop metric by
+        L = -(1 - 1/d1 - 1/d2 - t/min(d1, d2))+ - (1 - 1/d1 - 1/d2 - t/max(d1, d2))+ + t/max(d1, d2),
+        U = t/max(d1, d2),
+    for endpoint degrees d1, d2 and t common neighbors. Transport cost is
+    convex in mu, so the lower bound of a lazy walk is (1 - idleness) L; upper
+    bounds of lazy walks come from the 1-Lipschitz functions hop distance to
+    N(v1), to N(v1) with v1 and from v1 capped at 2. Weighted distances are
+    between the smallest and the largest edge weight times hop distances,
+    which turns hop transport costs into bounds of weighted ones.
+    """
+    if len(src) == 0:
+        return np.zeros((0, 2))
+    deg = np.diff(adj.indptr).astype(float)
+    d1, d2 = deg[src], deg[dst]
+    small, large = np.minimum(d1, d2), np.maximum(d1, d2)
+    t = _common_neighbors(adj, src, dst)
+    a = idleness
+
+    rest = 1 - 1/d1 - 1/d2
+    lower = -np.maximum(rest - t/small, 0) - np.maximum(rest - t/large, 0) + t/large
+    upper = np.minimum.reduce([2*a + (1-a)*t/large, a + (1-a)*(1+t)/large,
+                               (1-a)*(2+t)/large, np.ones(len(src))])
+
+    bounds = np.empty((len(src), 2))
+    bounds[:, 0] = (1-a) * (1 - adj.data.max()*(1-lower)/weights)
+    bounds[:, 1] = 1 - adj.data.min()*(1-upper)/weights
+    return bounds
+
+
+def ollivier_top_k_csr(adj, src, dst, weights, k, idleness, distances, largest=False, batch=256):
+    """Find the k edges of smallest (or largest) Ollivier-Ricci curvature.
+
+    Exact curvature is computed only for edges whose bounds reach past the
+    current k-th value: candidates go by their lower bound, batch at a time,
+    and every exact value may lower the cut-off, which starts at the k-th
+    smallest upper bound. Returns edge indices and their curvature, sorted.
+    """
+    k = min(k, len(src))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    with phase('ollivier.bounds'):
+        bounds = ollivier_bounds(adj, src, dst, weights, idleness)
+    # the largest values are the smallest of the negated curvature
+    lower, upper = (-bounds[:, 1], -bounds[:, 0]) if largest else (bounds[:, 0], bounds[:, 1])
+
+    known = upper.copy()
+    exact = np.zeros(len(src), dtype=bool)
+    cutoff = np.partition(known, k-1)[k-1]
+    order = np.argsort(lower, kind='stable')
+    for start in range(0, len(src), batch):
+        edges = order[start:start+batch]
+        edges = edges[lower[edges] <= cutoff]
+        if len(edges) == 0:
+            break
+        values = ollivier_csr(adj, src[edges], dst[edges], weights[edges], idleness, distances)
+        known[edges] = -values if largest else values
+        exact[edges] = True
+        cutoff = np.partition(known, k-1)[k-1]
+    count('ollivier.exact_edges', int(exact.sum()))
+
+    # every edge that can be among the k smallest now has its exact value
+    top = np.flatnonzero(exact)
+    top = top[np.argsort(known[top], kind='stable')[:k]]
+    return top, (-known[top] if largest else known[top])
+
+
+def ollivier_sweep_csr(adj, src, dst, weights, idleness, distances, tol=1e-9):
+    """Calculate ollivier_csr of edges (src, dst) for every value in idleness.
+
+    Returns an E x len(idleness) array. Idleness only moves mass between a
+    vertex and its neighbors, so every edge builds its supports and cost
+    matrix once. Its transport cost is a convex piecewise linear function of
+    idleness: once a solved grid point lies on the chord between two solved
+    ones (within tol), the function is linear between them and the grid points
+    in between are interpolated instead of solved. The number of solves then
+    follows the number of breakpoints, not the grid size.
+    """
+    idleness = np.asarray(idleness, dtype=float)
+    grid, back = np.unique(idleness, return_inverse=True)
+    curvature = np.empty((len(src), len(grid)))
+    solves = 0
+    lap = _laps()
+    for k, (v1, v2) in enumerate(zip(src.tolist(), dst.tolist())):
+        check_stop()
+        support1, mu1 = _local_mu(adj, v1, 0.)
+        support2, mu2 = _local_mu(adj, v2, 0.)
+        lap('ollivier.mu')
+        cost = distances.submatrix(support1, support2)
+        lap('ollivier.cost')
+
+        def transport(i):
+            # only the mass on the vertex itself moves with idleness
+            a = grid[i]
+            return ot.emd2(np.append(mu1[:-1] * (1-a), a), np.append(mu2[:-1] * (1-a), a), cost)
+
+        wd = np.empty(len(grid))
+        wd[0] = transport(0)
+        wd[-1] = transport(len(grid) - 1)
+        solves += min(2, len(grid))
+        pending = [(0, len(grid) - 1)]
+        while pending:
+            i, j = pending.pop()
+            if j - i < 2:
+                continue
+            m = (i + j) // 2
+            chord = wd[i] + (wd[j] - wd[i]) * (grid[i+1:j] - grid[i]) / (grid[j] - grid[i])
+            wd[m] = transport(m)
+            solves += 1
+            if abs(wd[m] - chord[m-i-1]) <= tol:
+                wd[i+1:j] = chord
+            else:
+                pending += [(i, m), (m, j)]
+        curvature[k] = 1 - wd/weights[k]
+        lap('ollivier.emd')
+    lap.done()
+    count('ollivier.emd_calls', solves)
+    return curvature[:, back]
+
+
 def draw_graph(gr, attr='weight'):
     """Draw graph showing edge attribute ('weight' by default). Returns plt"""
     pos = nx.drawing.layout.kamada_kawai_layout(gr)
@@ -57,24 +1027,785 @@ def draw_graph(gr, attr='weight'):
     return plt
 
 
-def forman(gr, fix=True):
-    """Add 'forman' attribute to graph edges and fill it with Forman-Ricci curvature."""
+def forman(gr, fix=True, write=True, cache=None):
+    """Calculate Forman-Ricci curvature of every edge, return it in gr.edges() order.
+
+    With write=True the values are also stored in the 'forman' edge attribute.
+    cache is an object with key(*parts), get(key) and put(key, array) methods,
+    such as result_cache.ResultCache; results are looked up there first.
+    """
     if fix:
         _fix_graph(gr)
 
-    for e in gr.edges():
-        gr.edges[e]['forman'] = _forman_edge(gr, e)
+    with phase('forman.arrays'):
+        adj, node_weights, src, dst, weights = _graph_arrays(gr)
+    curvature = None
+    if cache is not None:
+        key = cache.key('forman', adj.shape[0], src, dst, weights, node_weights, gr.is_directed())
+        curvature = cache.get(key)
+    if curvature is None:
+        with phase('forman.curvature'):
+            curvature = forman_csr(adj, node_weights, src, dst, weights)
+        if cache is not None:
+            cache.put(key, curvature)
+    if write:
+        _write_edges(gr, 'forman', curvature)
+    return curvature
 
 
-def ollivier(gr, idleness=0, fix=True):
-    """Add 'ollivier' attribute to graph edges and fill it with Ollivier-Ricci curvature."""
+def _distance_limit(adj, directed):
+    # neighborhoods of adjacent vertices are at most 3 edges apart; without
+    # edges no distances are needed
+    return np.inf if directed else 3 * adj.data.max(initial=0.)
+
+
+def _distances(adj, directed, kind, max_bytes, dynamic=False):
+    """Create a distance provider for Ollivier calculations.
+
+    kind is 'dense', 'sparse' or None to choose by graph size;
+    sparse providers are DynamicDistances if dynamic is set.
+    """
+    if kind is None:
+        kind = 'dense' if adj.shape[0] <= DENSE_DISTANCE_NODES else 'sparse'
+    if kind == 'dense':
+        with phase('distances.all_pairs'):
+            return DenseDistances(dijkstra(adj))
+    if kind == 'sparse':
+        if dynamic:
+            return DynamicDistances(adj, _distance_limit(adj, directed), max_bytes)
+        return ShortestPaths(adj, _distance_limit(adj, directed), max_bytes)
+    raise ValueError('unknown distances kind: %r' % kind)
+
+
+def ollivier(gr, idleness=0, fix=True, local=True, write=True,
+             distances=None, max_bytes=DISTANCE_CACHE_BYTES, workers=1,
+             method='emd', eps=0.01, tol=1e-6, max_iter=500, check=100, cache=None):
+    """Calculate Ollivier-Ricci curvature of every edge, return it in gr.edges() order.
+
+    With local=True the transport problems are restricted to the supports of mu,
+    otherwise full-length mu vectors and Floyd-Warshall distances are used.
+    distances selects 'dense' all-pairs distances or 'sparse' on-demand ones
+    cached within max_bytes; by default it depends on the graph size.
+    workers > 1 splits local exact (method='emd') transport problems among
+    that many processes; other methods and local=False run in one process only.
+    method='sinkhorn' solves local problems approximately, to within eps with
+    at most max_iter iterations per stage (see ollivier_sinkhorn); it needs
+    local=True and stores the largest deviation from exact values on check
+    sampled edges in the 'ollivier_error' graph attribute. method='bounds' returns an E x 2
+    array of lower and upper bounds instead (see ollivier_bounds), stored in
+    the 'ollivier_lower' and 'ollivier_upper' edge attributes with write=True.
+    With write=True the values are also stored in the 'ollivier' edge attribute.
+    cache is used as in forman for exact (method='emd') results.
+    """
+    if method not in ('emd', 'sinkhorn', 'bounds'):
+        raise ValueError('unknown method: %r' % method)
+    if method == 'sinkhorn' and not local:
+        raise ValueError("method='sinkhorn' solves local transport problems only, use local=True")
+    if workers > 1 and not (local and method == 'emd'):
+        raise ValueError("workers > 1 needs local=True and method='emd'")
     if fix:
         _fix_graph(gr)
 
-    floyd_warshall = nx.algorithms.shortest_paths.dense.floyd_warshall_numpy(gr)
-    for e in gr.edges():
-        v1, v2 = e
-        mu1 = _create_mu(v1, gr, idleness)
-        mu2 = _create_mu(v2, gr, idleness)
-        wd = ot.emd2(mu1, mu2, floyd_warshall)
-        gr.edges[e]['ollivier'] = 1 - wd/gr.edges[e]['weight']
+    if local or cache is not None or method == 'bounds':
+        with phase('ollivier.arrays'):
+            adj, _, src, dst, weights = _graph_arrays(gr)
+    if method == 'bounds':
+        if gr.is_directed():
+            raise nx.NetworkXNotImplemented('not implemented for directed type')
+        with phase('ollivier.bounds'):
+            bounds = ollivier_bounds(adj, src, dst, weights, idleness)
+        if write:
+            _write_edges(gr, 'ollivier_lower', bounds[:, 0])
+            _write_edges(gr, 'ollivier_upper', bounds[:, 1])
+        return bounds
+    key = None
+    if cache is not None and method == 'emd':
+        key = cache.key('ollivier', adj.shape[0], src, dst, weights, gr.is_directed(), idleness)
+        curvature = cache.get(key)
+        if curvature is not None:
+            if write:
+                _write_edges(gr, 'ollivier', curvature)
+            return curvature
+
+    if local:
+        provider = _distances(adj, gr.is_directed(), distances, max_bytes)
+        if method == 'sinkhorn':
+            with phase('ollivier.sinkhorn'):
+                curvature = ollivier_sinkhorn(adj, src, dst, weights, idleness, provider, eps, tol, max_iter)
+            sample = np.random.default_rng(0).choice(len(src), min(check, len(src)), replace=False)
+            exact = ollivier_csr(adj, src[sample], dst[sample], weights[sample], idleness, provider)
+            gr.graph['ollivier_error'] = np.abs(curvature[sample] - exact).max(initial=0)
+        elif workers > 1:
+            with phase('ollivier.pool'):
+                curvature = ollivier_pool(adj, src, dst, weights, idleness, provider, workers)
+        else:
+            curvature = ollivier_csr(adj, src, dst, weights, idleness, provider)
+    else:
+        with phase('ollivier.floyd_warshall'):
+            floyd_warshall = nx.algorithms.shortest_paths.dense.floyd_warshall_numpy(gr)
+        curvature = np.empty(gr.number_of_edges())
+        lap = _laps()
+        for k, e in enumerate(gr.edges()):
+            check_stop()
+            v1, v2 = e
+            mu1 = _create_mu(v1, gr, idleness)
+            mu2 = _create_mu(v2, gr, idleness)
+            lap('ollivier.mu')
+            wd = ot.emd2(mu1, mu2, floyd_warshall)
+            curvature[k] = 1 - wd/gr.edges[e]['weight']
+            lap('ollivier.emd')
+        lap.done()
+        count('ollivier.emd_calls', len(curvature))
+
+    if key is not None:
+        cache.put(key, curvature)
+    if write:
+        _write_edges(gr, 'ollivier', curvature)
+    return curvature
+
+
+def ollivier_top_k(gr, k, largest=False, idleness=0, fix=True,
+                   distances=None, max_bytes=DISTANCE_CACHE_BYTES):
+    """Find the k edges of an undirected graph with the most negative (or, with
+    largest=True, most positive) Ollivier-Ricci curvature.
+
+    Bounds screen out the edges that can not make it, see ollivier_top_k_csr.
+    Returns a list of edges and an array of their curvature, sorted.
+    """
+    if gr.is_directed():
+        raise nx.NetworkXNotImplemented('not implemented for directed type')
+    if fix:
+        _fix_graph(gr)
+    with phase('ollivier.arrays'):
+        adj, _, src, dst, weights = _graph_arrays(gr)
+    provider = _distances(adj, False, distances, max_bytes)
+    top, curvature = ollivier_top_k_csr(adj, src, dst, weights, k, idleness, provider, largest)
+    edges = list(gr.edges())
+    return [edges[i] for i in top.tolist()], curvature
+
+
+def ollivier_sweep(gr, idleness, fix=True, distances=None, max_bytes=DISTANCE_CACHE_BYTES, tol=1e-9):
+    """Calculate Ollivier-Ricci curvature of every edge for every value in idleness.
+
+    Returns an E x len(idleness) array with rows in gr.edges() order, see
+    ollivier_sweep_csr; nothing is written to the graph.
+    """
+    if fix:
+        _fix_graph(gr)
+    with phase('ollivier.arrays'):
+        adj, _, src, dst, weights = _graph_arrays(gr)
+    provider = _distances(adj, gr.is_directed(), distances, max_bytes)
+    return ollivier_sweep_csr(adj, src, dst, weights, idleness, provider, tol)
+
+
+def forman_edges(n, src, dst, weights, node_weights=None, directed=False):
+    """Calculate Forman-Ricci curvature of edge arrays, without a networkx graph."""
+    if node_weights is None:
+        node_weights = np.ones(n)
+    with phase('forman.arrays'):
+        adj, _ = _edge_csr(n, src, dst, weights, directed)
+    with phase('forman.curvature'):
+        return forman_csr(adj, node_weights, src, dst, weights)
+
+
+def ollivier_edges(n, src, dst, weights, idleness=0, directed=False,
+                   distances=None, max_bytes=DISTANCE_CACHE_BYTES, workers=1):
+    """Calculate Ollivier-Ricci curvature of edge arrays, without a networkx graph.
+
+    Parameters mean the same as in ollivier with local=True.
+    """
+    with phase('ollivier.arrays'):
+        adj, _ = _edge_csr(n, src, dst, weights, directed)
+    provider = _distances(adj, directed, distances, max_bytes)
+    if workers > 1:
+        with phase('ollivier.pool'):
+            return ollivier_pool(adj, src, dst, weights, idleness, provider, workers)
+    return ollivier_csr(adj, src, dst, weights, idleness, provider)
+
+
+def _temporary_array(shape, dtype, tmpdir=None):
+    """Array memory-mapped to an anonymous temporary file, removed with the array."""
+    # the mapping keeps the file alive after it is closed
+    with tempfile.TemporaryFile(dir=tmpdir) as f:
+        return np.memmap(f, dtype=dtype, mode='w+', shape=shape)
+
+
+def _open_edges(edges):
+    if isinstance(edges, str):
+        edges = np.load(edges, mmap_mode='r')
+    if edges.ndim != 2 or edges.shape[1] not in (2, 3):
+        raise ValueError('expected an E x 2 or E x 3 edge array, got shape %s' % (edges.shape,))
+    return edges
+
+
+def _block_rows(edges, max_bytes):
+    """Rows of an edge array read at once within max_bytes."""
+    # a row is read as int64 endpoints and a float weight plus temporaries
+    return max(1, max_bytes // (4 * 8 * edges.shape[1]))
+
+
+def sort_edges(edges, path, directed=False, max_bytes=STREAM_BYTES, tmpdir=None):
+    """Write an edge array in the node-sorted form read by EdgeStream, without loading it.
+
+    edges is an E x 2 or E x 3 array of source, target and weight rows (or the
+    path of a .npy file holding one) in any order. The result is saved to the
+    .npy file path as an E' x 3 float array and returned memory-mapped: rows are
+    sorted by source, then target, undirected edges are listed in both
+    directions, self-loops are dropped and of repeated edges the first one is
+    kept. Edges are counted, scattered and sorted max_bytes at a time through
+    temporary files in tmpdir.
+    """
+    edges = _open_edges(edges)
+    # undirected edges take two rows, and sorting copies them
+    block = max(1, _block_rows(edges, max_bytes) // 4)
+
+    def blocks():
+        for a in range(0, len(edges), block):
+            rows = edges[a:a+block]
+            src = rows[:, 0].astype(np.int64)
+            dst = rows[:, 1].astype(np.int64)
+            weights = rows[:, 2].astype(float) if edges.shape[1] > 2 else np.ones(len(rows))
+            keep = src != dst
+            src, dst, weights = src[keep], dst[keep], weights[keep]
+            if not directed:
+                src, dst = np.concatenate([src, dst]), np.concatenate([dst, src])
+                weights = np.concatenate([weights, weights])
+            # stable, so repeated edges keep the order they came in
+            order = np.argsort(src, kind='stable')
+            yield src[order], dst[order], weights[order]
+
+    with phase('stream.sort'):
+        n = 0
+        for src, dst, _ in blocks():
+            n = max(n, int(src.max(initial=-1)) + 1)
+
+        indptr = _temporary_array(n + 1, np.int64, tmpdir)
+        indptr[:] = 0
+        for src, _, _ in blocks():
+            nodes, counts = np.unique(src, return_counts=True)
+            indptr[nodes + 1] += counts
+        total = 0
+        for a in range(0, n + 1, block):
+            piece = np.cumsum(indptr[a:a+block]) + total
+            indptr[a:a+block] = piece
+            total = int(piece[-1])
+
+        # counting sort by source: every block goes behind what its nodes already got
+        scattered = _temporary_array((max(total, 1), 3), float, tmpdir)
+        cursor = _temporary_array(n, np.int64, tmpdir)
+        cursor[:] = indptr[:-1]
+        for src, dst, weights in blocks():
+            nodes, first, counts = np.unique(src, return_index=True, return_counts=True)
+            pos = cursor[src] + np.arange(len(src)) - np.repeat(first, counts)
+            scattered[pos, 0] = src
+            scattered[pos, 1] = dst
+            scattered[pos, 2] = weights
+            cursor[nodes] += counts
+
+        # sort every source by target and drop repeats, compacting in place;
+        # blocks end at source boundaries, so repeats never fall into two blocks
+        kept, a = 0, 0
+        while a < total:
+            b = min(total, a + block)
+            b = int(indptr[int(scattered[b-1, 0]) + 1])
+            rows = np.array(scattered[a:b])
+            rows = rows[np.lexsort((rows[:, 1], rows[:, 0]))]
+            new = np.ones(len(rows), dtype=bool)
+            new[1:] = (rows[1:, 0] != rows[:-1, 0]) | (rows[1:, 1] != rows[:-1, 1])
+            rows = rows[new]
+            scattered[kept:kept+len(rows)] = rows
+            kept += len(rows)
+            a = b
+
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=float, shape=(kept, 3))
+        for a in range(0, kept, block):
+            out[a:a+block] = scattered[a:min(kept, a+block)]
+        out.flush()
+    return out
+
+
+class EdgeStream:
+    """Node-sorted edge array read in pieces, with the CSR row offsets of its sources.
+
+    edges is an E x 2 or E x 3 array (usually memory-mapped, or the path of a
+    .npy file) of source, target and weight rows sorted by source, then target,
+    without repeats; undirected graphs list every edge in both directions, as
+    sort_edges writes them. The row offsets live in a temporary file, so only
+    the pieces asked for are held in memory.
+    """
+
+    def __init__(self, edges, n=None, directed=False, max_bytes=STREAM_BYTES, tmpdir=None):
+        self.edges = _open_edges(edges)
+        self.directed = directed
+        self.block = _block_rows(self.edges, max_bytes)
+
+        max_id, self.max_weight, last = -1, 0., None
+        with phase('stream.scan'):
+            for a in range(0, len(self.edges), self.block):
+                src, dst, weights = self.read(a, a + self.block)
+                if last is not None:
+                    src, dst = np.append(last[0], src), np.append(last[1], dst)
+                if ((src[1:] < src[:-1]) | ((src[1:] == src[:-1]) & (dst[1:] <= dst[:-1]))).any():
+                    raise ValueError('edges must be sorted by source, then target, without repeats')
+                last = src[-1], dst[-1]
+                max_id = max(max_id, int(src.max()), int(dst.max()))
+                self.max_weight = max(self.max_weight, float(weights.max()))
+            self.n = max_id + 1 if n is None else n
+
+            self.indptr = _temporary_array(self.n + 1, np.int64, tmpdir)
+            done = 0
+            for a in range(0, len(self.edges), self.block):
+                src = self.edges[a:a+self.block, 0].astype(np.int64)
+                nodes = np.arange(done, src[-1] + 1)
+                self.indptr[done:src[-1]+1] = a + np.searchsorted(src, nodes)
+                done = src[-1] + 1
+            self.indptr[done:] = len(self.edges)
+
+    def __len__(self):
+        return len(self.edges)
+
+    def read(self, start, stop):
+        """Source, target and weight arrays of rows start to stop."""
+        rows = self.edges[start:stop]
+        weights = rows[:, 2].astype(float) if self.edges.shape[1] > 2 else np.ones(len(rows))
+        return rows[:, 0].astype(np.int64), rows[:, 1].astype(np.int64), weights
+
+    def degrees(self, nodes):
+        return self.indptr[nodes + 1] - self.indptr[nodes]
+
+    def neighborhoods(self, nodes):
+        """Rows, as source, target and weight arrays, of the given sorted distinct sources."""
+        starts = np.asarray(self.indptr[nodes])
+        lengths = np.asarray(self.indptr[nodes + 1]) - starts
+        pos = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        weights = self.edges[pos, 2].astype(float) if self.edges.shape[1] > 2 else np.ones(len(pos))
+        return np.repeat(nodes, lengths), self.edges[pos, 1].astype(np.int64), weights
+
+    def find(self, src, dst):
+        """Row of every edge (src[k], dst[k]), -1 where there is none."""
+        lo = np.asarray(self.indptr[src])
+        end = np.asarray(self.indptr[src + 1])
+        hi = end.copy()
+        # binary search inside the rows of every source at once
+        while (lo < hi).any():
+            active = np.flatnonzero(lo < hi)
+            mid = (lo[active] + hi[active]) // 2
+            less = self.edges[mid, 1].astype(np.int64) < dst[active]
+            lo[active[less]] = mid[less] + 1
+            hi[active[~less]] = mid[~less]
+        rows = np.full(len(src), -1, dtype=np.int64)
+        inside = np.flatnonzero(lo < end)
+        match = self.edges[lo[inside], 1].astype(np.int64) == dst[inside]
+        rows[inside[match]] = lo[inside[match]]
+        return rows
+
+
+class _CsrRows:
+    """The degrees and neighborhoods of EdgeStream over an in-memory CSR adjacency, for _ball."""
+
+    def __init__(self, adj):
+        self.adj = adj
+
+    def degrees(self, nodes):
+        return self.adj.indptr[nodes + 1] - self.adj.indptr[nodes]
+
+    def neighborhoods(self, nodes):
+        starts = self.adj.indptr[nodes]
+        lengths = self.adj.indptr[nodes + 1] - starts
+        pos = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return np.repeat(nodes, lengths), self.adj.indices[pos].astype(np.int64), self.adj.data[pos]
+
+
+def _local_csr(nodes, src, dst, weights):
+    """CSR adjacency over the sorted node ids nodes of rows with both ends among them."""
+    rows = np.searchsorted(nodes, src)
+    cols = np.minimum(np.searchsorted(nodes, dst), len(nodes) - 1)
+    inside = nodes[cols] == dst
+    adj = sp.csr_array((weights[inside], (rows[inside], cols[inside])), shape=(len(nodes), len(nodes)))
+    adj.sort_indices()
+    return adj
+
+
+def _stream_output(out, length):
+    if out is None:
+        return np.empty(length)
+    if isinstance(out, str):
+        return np.lib.format.open_memmap(out, mode='w+', dtype=float, shape=(length,))
+    if len(out) != length:
+        raise ValueError('output has %d values for %d edges' % (len(out), length))
+    return out
+
+
+def _stream_chunks(stream, compute, max_entries):
+    """Feed row ranges to compute(start, stop), which returns None when they need
+    more than max_entries neighborhood rows; ranges shrink and grow to fit."""
+    size, start = 1024, 0
+    while start < len(stream):
+        check_stop()
+        stop = min(len(stream), start + size)
+        used = compute(start, stop)
+        if used is None:
+            if stop - start == 1:
+                raise MemoryError('the neighborhood of edge row %d does not fit into max_bytes' % start)
+            size = (stop - start) // 2
+            continue
+        count('stream.chunks')
+        start = stop
+        if used < max_entries // 4:
+            size *= 2
+
+
+def forman_stream(edges, out=None, n=None, node_weights=None, directed=False,
+                  max_bytes=STREAM_BYTES, tmpdir=None):
+    """Calculate Forman-Ricci curvature of every row of a node-sorted edge array.
+
+    edges is read through EdgeStream and only the rows of the endpoints of a
+    chunk of edges are loaded at a time, so memory stays within about
+    max_bytes whatever the graph size. out is an array to write the values to,
+    the path of a .npy file to create memory-mapped, or None for a new array;
+    it is returned. node_weights may be memory-mapped too.
+    """
+    stream = edges if isinstance(edges, EdgeStream) else EdgeStream(edges, n, directed, max_bytes, tmpdir)
+    out = _stream_output(out, len(stream))
+    max_entries = max_bytes // STREAM_ENTRY_BYTES
+
+    def compute(start, stop):
+        src, dst, weights = stream.read(start, stop)
+        ends = np.union1d(src, dst)
+        used = int(stream.degrees(ends).sum())
+        if used > max_entries:
+            return None
+        with phase('stream.neighborhoods'):
+            rows, cols, row_weights = stream.neighborhoods(ends)
+            nodes = np.union1d(ends, cols)
+            adj = _local_csr(nodes, rows, cols, row_weights)
+        local_weights = np.ones(len(nodes)) if node_weights is None else np.asarray(node_weights[nodes])
+        with phase('forman.curvature'):
+            out[start:stop] = forman_csr(adj, local_weights, np.searchsorted(nodes, src),
+                                         np.searchsorted(nodes, dst), weights)
+        return used
+
+    _stream_chunks(stream, compute, max_entries)
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+def _ball(stream, sources, radius, max_entries):
+    """Nodes within radius of the sorted nodes sources and their rows, None if
+    those are more than max_entries."""
+    nodes, dist = sources, np.zeros(len(sources))
+    loaded = np.zeros(len(sources), dtype=bool)
+    parts, used = [], 0
+    frontier = sources
+    while len(frontier):
+        new = frontier[~loaded[np.searchsorted(nodes, frontier)]]
+        used += int(stream.degrees(new).sum())
+        if used > max_entries:
+            return None
+        rows, cols, weights = stream.neighborhoods(frontier)
+        fresh = np.isin(rows, new, assume_unique=False)
+        parts.append((rows[fresh], cols[fresh], weights[fresh]))
+        loaded[np.searchsorted(nodes, new)] = True
+
+        reach = dist[np.searchsorted(nodes, rows)] + weights
+        near = reach <= radius
+        cols, reach = cols[near], reach[near]
+        order = np.lexsort((reach, cols))
+        cols, reach = cols[order], reach[order]
+        first = np.ones(len(cols), dtype=bool)
+        first[1:] = cols[1:] != cols[:-1]
+        cols, reach = cols[first], reach[first]
+
+        pos = np.minimum(np.searchsorted(nodes, cols), len(nodes) - 1)
+        known = nodes[pos] == cols
+        better = known & (reach < dist[pos])
+        dist[pos[better]] = reach[better]
+        # nodes already loaded are expanded again from their shorter distance
+        frontier = np.union1d(cols[better], cols[~known])
+        if (~known).any():
+            nodes = np.concatenate([nodes, cols[~known]])
+            dist = np.concatenate([dist, reach[~known]])
+            loaded = np.concatenate([loaded, np.zeros((~known).sum(), dtype=bool)])
+            order = np.argsort(nodes)
+            nodes, dist, loaded = nodes[order], dist[order], loaded[order]
+    rows, cols, weights = (np.concatenate(arrays) for arrays in zip(*parts))
+    return nodes, rows, cols, weights, used
+
+
+def ollivier_stream(edges, out=None, n=None, idleness=0, max_bytes=STREAM_BYTES, tmpdir=None):
+    """Calculate Ollivier-Ricci curvature of every row of an undirected node-sorted edge array.
+
+    Works like forman_stream. A chunk of edges loads the rows of the nodes
+    within 1.5 times the largest edge weight of the supports of its mu, which
+    hold every shortest path the transport costs use, so the values equal
+    those of ollivier_edges. Every edge is computed once and copied to the row
+    listing it backwards. Half of max_bytes goes to loaded rows, the other
+    half to distance rows.
+    """
+    stream = edges if isinstance(edges, EdgeStream) else EdgeStream(edges, n, False, max_bytes, tmpdir)
+    if stream.directed:
+        raise nx.NetworkXNotImplemented('not implemented for directed type')
+    out = _stream_output(out, len(stream))
+    max_entries = max_bytes // 2 // STREAM_ENTRY_BYTES
+    # as in _distances: supports of adjacent vertices are at most 3 edges apart,
+    # and a path not longer than that stays within half of it from its ends
+    limit = 3 * stream.max_weight
+
+    def compute(start, stop):
+        src, dst, weights = stream.read(start, stop)
+        forward = np.flatnonzero(src <= dst)
+        if len(forward):
+            ends = np.union1d(src[forward], dst[forward])
+            if stream.degrees(ends).sum() > max_entries:
+                return None
+            with phase('stream.neighborhoods'):
+                supports = np.union1d(ends, stream.neighborhoods(ends)[1])
+                ball = _ball(stream, supports, limit / 2, max_entries)
+                if ball is None:
+                    return None
+                nodes, rows, cols, row_weights, used = ball
+                adj = _local_csr(nodes, rows, cols, row_weights)
+            provider = ShortestPaths(adj, limit, max_bytes // 2)
+            out[start + forward] = ollivier_csr(
+                adj, np.searchsorted(nodes, src[forward]), np.searchsorted(nodes, dst[forward]),
+                weights[forward], idleness, provider)
+        else:
+            used = 0
+
+        backward = np.flatnonzero(src > dst)
+        if len(backward):
+            twins = stream.find(dst[backward], src[backward])
+            if (twins < 0).any():
+                raise ValueError('edge (%d, %d) is not listed in both directions'
+                                 % (dst[backward][twins < 0][0], src[backward][twins < 0][0]))
+            out[start + backward] = out[twins]
+        return used
+
+    _stream_chunks(stream, compute, max_entries)
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+class CurvatureTracker:
+    """Forman and Ollivier curvature of an undirected graph kept up to date under edits.
+
+    Edits made through the tracker mark the nodes around them dirty and drop
+    the distance rows they can change; update() recomputes only the edges whose
+    curvature can depend on the edits and writes them to the 'forman' and
+    'ollivier' edge attributes. Nodes can not be added or removed.
+    """
+
+    def __init__(self, gr, idleness=0, fix=True, max_bytes=DISTANCE_CACHE_BYTES):
+        if gr.is_directed():
+            raise nx.NetworkXNotImplemented('not implemented for directed type')
+        if fix:
+            _fix_graph(gr)
+        self.gr = gr
+        self.idleness = idleness
+        self.nodes = list(gr.nodes())
+        self.index = {v: i for i, v in enumerate(self.nodes)}
+
+        self.adj, self.node_weights, src, dst, weights = _graph_arrays(gr)
+        self.distances = ShortestPaths(self.adj, _distance_limit(self.adj, False), max_bytes)
+        self._forman_dirty = set()
+        self._ollivier_dirty = set()
+
+        _write_edges(gr, 'forman', forman_csr(self.adj, self.node_weights, src, dst, weights))
+        _write_edges(gr, 'ollivier', ollivier_csr(self.adj, src, dst, weights, idleness, self.distances))
+
+    def set_weight(self, u, v, weight):
+        """Change the weight of an existing edge."""
+        i, j = self.index[u], self.index[v]
+        self._touch(i, j)
+        self.gr.edges[u, v]['weight'] = weight
+        for a, b in ((i, j), (j, i)):
+            row = slice(self.adj.indptr[a], self.adj.indptr[a+1])
+            self.adj.data[row][np.searchsorted(self.adj.indices[row], b)] = weight
+        self._touch(i, j)
+
+    def add_edge(self, u, v, weight=1):
+        """Add an edge between two existing nodes.
+
+        Like nx.Graph.add_edge, adding an edge that exists sets its weight.
+        """
+        if self.gr.has_edge(u, v):
+            self.set_weight(u, v, weight)
+            return
+        i, j = self.index[u], self.index[v]
+        self._touch(i, j)
+        self.gr.add_edge(u, v, weight=weight)
+        rows, cols = ([i, j], [j, i]) if i != j else ([i], [i])
+        added = sp.csr_array(([weight] * len(rows), (rows, cols)), shape=self.adj.shape)
+        self._set_adj(self.adj + added)
+        self._touch(i, j)
+
+    def remove_edge(self, u, v):
+        """Remove an existing edge."""
+        i, j = self.index[u], self.index[v]
+        self._touch(i, j)
+        self.gr.remove_edge(u, v)
+        coo = self.adj.tocoo()
+        keep = ~(((coo.row == i) & (coo.col == j)) | ((coo.row == j) & (coo.col == i)))
+        self._set_adj(sp.csr_array(
+            (coo.data[keep], (coo.row[keep], coo.col[keep])), shape=self.adj.shape
+        ))
+        self._touch(i, j)
+
+    def set_node_weight(self, v, weight):
+        """Change the weight of a node; only Forman curvature depends on it."""
+        i = self.index[v]
+        self.gr.nodes[v]['weight'] = weight
+        self.node_weights[i] = weight
+        self._forman_dirty.add(i)
+
+    def update(self):
+        """Recompute curvature of the edges affected by edits since the last update.
+
+        Returns the lists of edges with recomputed Forman and Ollivier curvature.
+        """
+        updated = []
+        for dirty, attr in ((self._forman_dirty, 'forman'), (self._ollivier_dirty, 'ollivier')):
+            edges = list(self.gr.edges(self.nodes[i] for i in dirty))
+            dirty.clear()
+            if not edges:
+                updated.append(edges)
+                continue
+            src = np.array([self.index[e[0]] for e in edges])
+            dst = np.array([self.index[e[1]] for e in edges])
+            weights = np.array([self.gr.edges[e]['weight'] for e in edges], dtype=float)
+            if attr == 'forman':
+                values = forman_csr(self.adj, self.node_weights, src, dst, weights)
+            else:
+                values = ollivier_csr(self.adj, src, dst, weights, self.idleness, self.distances)
+            for e, val in zip(edges, values.tolist()):
+                self.gr.edges[e][attr] = val
+            updated.append(edges)
+        return updated
+
+    def _set_adj(self, adj):
+        adj.sort_indices()
+        self.adj = adj
+        self.distances.adj = adj
+
+    def _touch(self, i, j):
+        """Mark what the edge (i, j) influences; called both before and after an edit."""
+        self._forman_dirty.update((i, j))
+        limit = _distance_limit(self.adj, False)
+        self.distances.limit = max(self.distances.limit, limit)
+        if not self.adj.nnz:
+            self._ollivier_dirty.update((i, j))
+            return
+
+        # a needed distance through (i, j) is at most limit, and the sources
+        # of an edge are one edge away from its endpoints
+        reach = dijkstra(self.adj, indices=[i, j], min_only=True, limit=limit + self.adj.data.max())
+        self._ollivier_dirty.update(np.flatnonzero(np.isfinite(reach)).tolist())
+        self.distances.forget(np.flatnonzero(reach <= self.distances.limit))
+
+
+def flow_step(weights, curvature, step=1., total=None):
+    """Ricci flow step w -= step * curvature * w, rescaled to sum to total if given."""
+    new_weights = weights - step * curvature * weights
+    if total is not None:
+        new_weights *= total / new_weights.sum()
+    return new_weights
+
+
+def ricci_flow_csr(n, src, dst, weights, node_weights=None, curvature='ollivier',
+                   iterations=20, step=1., tol=1e-6, idleness=0, normalize=True,
+                   directed=False, distances=None, max_bytes=DISTANCE_CACHE_BYTES,
+                   checkpoint=None, checkpoint_every=1, verify_distances=False):
+    """Run discrete Ricci flow on edge weight arrays, yielding after every iteration.
+
+    Every iteration computes curvature ('ollivier' or 'forman') of all edges
+    and sets w -= step * curvature * w; with normalize=True the weights are then
+    rescaled to keep their sum. Yields (iteration, weights, curvature), where
+    curvature belongs to the weights before the step. Stops after iterations
+    steps or when no weight changed by more than tol.
+
+    With checkpoint set to a file path the state is saved there every
+    checkpoint_every iterations, and a flow with the same edges, starting
+    weights and parameters resumes from it; a checkpoint of another flow
+    raises ValueError. If the saved flow already ran iterations steps or
+    converged, its last state is yielded once more and nothing is computed.
+
+    Sparse distances are kept in a DynamicDistances while the steps change
+    at most DYNAMIC_MAX_CHANGED of the weights, so an iteration recomputes
+    only the distance rows its weight changes affect; verify_distances
+    compares them with a full recompute after every update and raises
+    RuntimeError if they differ. Steps changing more weights, as normalized
+    ones do, get fresh ShortestPaths without the upkeep of the dynamic ones.
+    """
+    if curvature not in ('ollivier', 'forman'):
+        raise ValueError('unknown curvature: %r' % curvature)
+    if node_weights is None:
+        node_weights = np.ones(n)
+    weights = np.array(weights, dtype=float)
+    total = weights.sum()
+    # everything the saved weights depend on, a checkpoint must match all of it
+    flow = {'src': src, 'dst': dst, 'directed': directed, 'initial_weights': weights,
+            'node_weights': node_weights, 'curvature': curvature, 'step': step,
+            'idleness': idleness, 'normalize': normalize}
+
+    start = 0
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with np.load(checkpoint) as state:
+            for name, value in flow.items():
+                if name not in state or not np.array_equal(state[name], value):
+                    raise ValueError('checkpoint %s belongs to another flow: %s differs' % (checkpoint, name))
+            start = int(state['iteration'])
+            weights = state['weights']
+            total = float(state['total'])
+            if start >= iterations or float(state['change']) < tol:
+                yield start, weights, state['curv']
+                return
+
+    adj, slots = _edge_csr(n, src, dst, weights, directed)
+    provider, few_changed = None, False
+    for iteration in range(start+1, iterations+1):
+        check_stop()
+        adj.data = weights[slots]
+        if curvature == 'forman':
+            curv = forman_csr(adj, node_weights, src, dst, weights)
+        else:
+            if few_changed and isinstance(provider, DynamicDistances):
+                provider.update(adj.data, _distance_limit(adj, directed))
+                if verify_distances:
+                    error = provider.verify()
+                    if error > 1e-9:
+                        raise RuntimeError('dynamic distances differ from a full recompute by %g' % error)
+            else:
+                provider = _distances(adj, directed, distances, max_bytes, dynamic=few_changed)
+            curv = ollivier_csr(adj, src, dst, weights, idleness, provider)
+
+        new_weights = flow_step(weights, curv, step, total if normalize else None)
+        change = np.abs(new_weights - weights).max(initial=0)
+        few_changed = np.count_nonzero(new_weights != weights) <= DYNAMIC_MAX_CHANGED * len(weights)
+        weights = new_weights
+
+        if checkpoint is not None and (iteration % checkpoint_every == 0 or change < tol
+                                       or iteration == iterations):
+            # imported here, so that the module works without the app next to it
+            from result_cache import atomic_write
+            with atomic_write(checkpoint) as f:
+                np.savez(f, iteration=iteration, weights=weights, total=total, curv=curv,
+                         change=change, **flow)
+
+        yield iteration, weights, curv
+        if change < tol:
+            break
+
+
+def ricci_flow(gr, curvature='ollivier', fix=True, **kwargs):
+    """Run ricci_flow_csr on the edge weights of a graph.
+
+    Yields (iteration, weights, curvature) with arrays in gr.edges() order;
+    the graph itself is not changed.
+    """
+    if fix:
+        _fix_graph(gr)
+    adj, node_weights, src, dst, weights = _graph_arrays(gr)
+    return ricci_flow_csr(adj.shape[0], src, dst, weights, node_weights, curvature,
+                          directed=gr.is_directed(), **kwargs)
@@ -0,0 +1,168 @@
+import itertools
+import os
+from typing import Union
+
+import numpy as np
+import scipy.sparse as sp
+
+# lines of a text edge list parsed at once
+EDGE_LIST_CHUNK_LINES = 2**20
+# extensions read as text edge lists
+EDGE_LIST_EXTENSIONS = ('.txt', '.csv', '.tsv', '.edges', '.el')
+
+
+class EdgeGraph:
+    """Graph given by edge arrays: edge k goes from src[k] to dst[k] with weights[k].
+
+    Undirected graphs keep every edge once with src < dst, directed graphs keep
+    every arc once; self-loops are dropped. matrix is the dense adjacency if the
+    graph was made from one, None otherwise. ids are the original ids of the
+    vertices 0..n-1 if they were relabeled, None otherwise.
+    """
+
+    def __init__(self, n: int, src: np.ndarray, dst: np.ndarray, weights: np.ndarray,
+                 directed: bool, matrix: Union[np.ndarray, None] = None,
+                 ids: Union[np.ndarray, None] = None):
+        self.n = n
+        self.src = src
+        self.dst = dst
+        self.weights = weights
+        self.directed = directed
+        self.matrix = matrix
+        self.ids = ids
+
+    @property
+    def edge_count(self) -> int:
+        return len(self.src)
+
+    def vertex_ids(self, vertices: np.ndarray) -> np.ndarray:
+        """Original ids of vertices, for output."""
+        return vertices if self.ids is None else self.ids[vertices]
+
+
+def from_matrix(mat: np.ndarray) -> EdgeGraph:
+    """Graph of a dense adjacency matrix, directed unless the matrix is symmetric."""
+    mat = np.asarray(mat)
+    directed = not (mat.T == mat).all()
+    if directed:
+        src, dst = np.nonzero(mat - np.diag(np.diag(mat)))
+    else:
+        src, dst = np.nonzero(np.triu(mat, 1))
+    return EdgeGraph(mat.shape[0], src, dst, mat[src, dst], directed, mat)
+
+
+def from_edges(src, dst, weights=None, n=None, directed=False) -> EdgeGraph:
+    """Graph of edge arrays, which may contain self-loops and repeated edges.
+
+    Of repeated edges (in either direction if undirected) the first one is kept.
+    Without n the vertex ids are relabeled to 0..n-1 in sorted order, and the
+    original ones are kept in ids of the graph unless they were 0..n-1 already.
+    """
+    src = np.asarray(src).astype(np.int64)
+    dst = np.asarray(dst).astype(np.int64)
+    weights = np.ones(len(src)) if weights is None else np.asarray(weights).astype(float)
+    ids = None
+    if n is None:
+        ids, labels = np.unique(np.concatenate([src, dst]), return_inverse=True)
+        n = len(ids)
+        if not n or ids[0] == 0 and ids[-1] == n - 1:
+            ids = None
+        else:
+            src, dst = labels[:len(src)], labels[len(src):]
+    if not directed:
+        src, dst = np.minimum(src, dst), np.maximum(src, dst)
+
+    keep = src != dst
+    keys = src * n + dst
+    order = np.argsort(keys, kind='stable')
+    repeated = np.zeros(len(keys), dtype=bool)
+    repeated[order[1:]] = keys[order[1:]] == keys[order[:-1]]
+    keep &= ~repeated
+    if not keep.all():
+        src, dst, weights = src[keep], dst[keep], weights[keep]
+    return EdgeGraph(n, src, dst, weights, directed, ids=ids)
+
+
+def from_csr(adj) -> EdgeGraph:
+    """Graph of a SciPy sparse adjacency, directed unless it is symmetric."""
+    adj = sp.csr_array(adj)
+    adj.sum_duplicates()
+    adj.eliminate_zeros()
+    directed = (adj != adj.T).nnz > 0
+    if not directed:
+        adj = sp.triu(adj, 1, format='csr')
+    coo = adj.tocoo()
+    return from_edges(coo.row, coo.col, coo.data, adj.shape[0], directed)
+
+
+def load_edge_list(path: str, directed=False, chunk_lines=EDGE_LIST_CHUNK_LINES) -> EdgeGraph:
+    """Read a text file of 'source target [weight]' lines, chunk_lines at a time.
+
+    Values are separated by whitespace or commas; lines starting with # or %
+    and a header line are skipped. Vertex ids are relabeled as in from_edges.
+    """
+    srcs, dsts, weights = [], [], []
+    delimiter = None
+    with open(path) as f:
+        first = True
+        while True:
+            lines = list(itertools.islice(f, chunk_lines))
+            if not lines:
+                break
+            if first:
+                lines = [line for line in lines if line.strip() and line[0] not in '#%']
+                if not lines:
+                    continue
+                first = False
+                if ',' in lines[0]:
+                    delimiter = ','
+                try:
+                    float(lines[0].replace(',', ' ').split()[0])
+                except ValueError:
+                    lines = lines[1:]
+                if not lines:
+                    continue
+            rows = np.loadtxt(lines, delimiter=delimiter, comments=('#', '%'), ndmin=2)
+            if rows.size == 0:
+                continue
+            srcs.append(rows[:, 0].astype(np.int64))
+            dsts.append(rows[:, 1].astype(np.int64))
+            weights.append(rows[:, 2] if rows.shape[1] > 2 else np.ones(len(rows)))
+
+    if not srcs:
+        raise ValueError('no edges in %s' % path)
+    return from_edges(np.concatenate(srcs), np.concatenate(dsts), np.concatenate(weights),
+                      directed=directed)
+
+
+def load_array(array: np.ndarray, directed=False) -> EdgeGraph:
+    """Graph of a square adjacency matrix or of an E x 2 / E x 3 edge array."""
+    if array.ndim == 2 and array.shape[0] == array.shape[1]:
+        return from_matrix(array)
+    if array.ndim == 2 and array.shape[1] in (2, 3):
+        weights = array[:, 2] if array.shape[1] == 3 else None
+        return from_edges(array[:, 0], array[:, 1], weights, directed=directed)
+    raise ValueError('expected a square matrix or an edge array, got shape %s' % (array.shape,))
+
+
+def load_graph(path: str, directed=False) -> EdgeGraph:
+    """Load a graph, choosing the format by file extension and content.
+
+    .npy files hold an adjacency matrix or an edge array and are memory-mapped;
+    .npz files hold a SciPy sparse matrix, arrays named src, dst and optionally
+    weights, or a single array as in .npy files; anything else is read as a
+    text edge list. directed applies to edge lists only, matrices are directed
+    unless they are symmetric.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        return load_array(np.load(path, mmap_mode='r'), directed)
+    if ext == '.npz':
+        with np.load(path) as data:
+            if 'format' in data.files and 'indptr' in data.files:
+                return from_csr(sp.load_npz(path))
+            if 'src' in data.files and 'dst' in data.files:
+                weights = data['weights'] if 'weights' in data.files else None
+                return from_edges(data['src'], data['dst'], weights, directed=directed)
+            return load_array(data[data.files[0]], directed)
+    return load_edge_list(path, directed)
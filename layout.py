@@ -0,0 +1,160 @@
+import os
+
+import numpy as np
+
+from result_cache import ResultCache, content_key
+
+# computed layouts are kept here, one .npy file per adjacency hash
+LAYOUT_CACHE_DIR = os.environ.get(
+    'RICCI_LAYOUT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'ricci', 'layouts'))
+LAYOUT_CACHE_BYTES = 256 * 2**20
+# finest level of the repulsion grid hierarchy, 4**MAX_LEVEL cells
+MAX_LEVEL = 10
+# the grid is refined until a vertex shares its cell with this many others on average
+NEAR_FIELD_SIZE = 4
+# minimal distance between two vertices when computing forces
+MIN_DISTANCE = .01
+
+
+layout_cache = ResultCache(LAYOUT_CACHE_DIR, LAYOUT_CACHE_BYTES)
+
+
+def adjacency_key(n, src, dst, weights, *params) -> str:
+    """Content hash of an edge list and of the parameters it was laid out with."""
+    return content_key('layout', n, np.asarray(src, dtype=np.int64), np.asarray(dst, dtype=np.int64),
+                       np.asarray(weights, dtype=np.float64), *params)
+
+
+def load_layout(key: str, n: int):
+    """Coordinates saved under key, None if there are none for n vertices."""
+    coords = layout_cache.get(key, mmap=False)
+    return coords if coords is not None and coords.shape == (n, 2) else None
+
+
+def save_layout(key: str, coords: np.ndarray):
+    layout_cache.put(key, coords)
+
+
+def force_layout(n, src, dst, weights, k=None, iterations=50, every=5, tol=1e-4,
+                 pos=None, seed=0):
+    """Fruchterman-Reingold layout of an edge list, yielding coordinates as it refines.
+
+    Follows networkx.spring_layout: optimal distance k (1/sqrt(n) by default),
+    attraction proportional to weight * d**2 / k, repulsion to k**2 / d, every
+    vertex moving by a temperature that cools linearly. Repulsion is approximated
+    on a hierarchy of grids: pairs of vertices in neighbouring cells of the finest
+    grid repel exactly, farther vertices see the mass centers of the cells they
+    are well separated from, so an iteration costs O(E + n log n).
+
+    Yields coordinates rescaled to [-1, 1] every `every` iterations and once
+    after the last one; pos gives starting coordinates instead of random ones.
+    """
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    weights = np.asarray(weights, dtype=float)
+    if k is None:
+        k = np.sqrt(1. / max(n, 1))
+    if pos is None:
+        pos = np.random.default_rng(seed).random((n, 2))
+    else:
+        pos = np.array(pos, dtype=float)
+    if n < 2:
+        yield _rescale(pos)
+        return
+
+    temperature = max(np.ptp(pos, axis=0).max() * .1, MIN_DISTANCE)
+    cooling = temperature / (iterations + 1)
+    for iteration in range(1, iterations+1):
+        disp = _repulsion(pos, k)
+        delta = pos[src] - pos[dst]
+        dist = np.maximum(np.sqrt((delta**2).sum(1)), MIN_DISTANCE)
+        pull = delta * (weights * dist / k)[:, None]
+        for axis in range(2):
+            disp[:, axis] -= np.bincount(src, pull[:, axis], minlength=n)
+            disp[:, axis] += np.bincount(dst, pull[:, axis], minlength=n)
+
+        length = np.maximum(np.sqrt((disp**2).sum(1)), MIN_DISTANCE)
+        step = disp * (temperature / length)[:, None]
+        pos += step
+        temperature -= cooling
+
+        done = np.sqrt((step**2).sum()) / n < tol
+        if done or iteration == iterations or iteration % every == 0:
+            yield _rescale(pos)
+        if done:
+            break
+
+
+def _rescale(pos: np.ndarray) -> np.ndarray:
+    """Center coordinates and fit them into [-1, 1], like networkx.rescale_layout."""
+    pos = pos - pos.mean(0)
+    lim = np.abs(pos).max(initial=0)
+    return pos / lim if lim > 0 else pos
+
+
+def _repulsion(pos: np.ndarray, k: float) -> np.ndarray:
+    """Approximate sum over all other vertices of k**2 * delta / |delta|**2."""
+    n = len(pos)
+    x, y = pos[:, 0], pos[:, 1]
+    span = np.ptp(pos, axis=0).max() * (1 + 1e-9) + 1e-12
+    ux, uy = (x - x.min()) / span, (y - y.min()) / span
+    k2 = k * k
+    fx, fy = np.zeros(n), np.zeros(n)
+
+    # far field: cells that are not adjacent to the vertex cell, but whose
+    # parents are adjacent to its parent, are seen as points at their mass center;
+    # the grid gets finer until cells hold few enough vertices for exact near field
+    level, crowded = 0, True
+    while crowded:
+        level += 1
+        side = 2**level
+        cx = np.minimum((ux * side).astype(np.int64), side - 1)
+        cy = np.minimum((uy * side).astype(np.int64), side - 1)
+        keys = cy * side + cx
+        mass = np.bincount(keys, minlength=side*side).astype(float)
+        crowded = level < MAX_LEVEL and (mass**2).sum() > NEAR_FIELD_SIZE * n
+        count = np.maximum(mass, 1)
+        mx = np.bincount(keys, x, minlength=side*side) / count
+        my = np.bincount(keys, y, minlength=side*side) / count
+        # which of the 6 x 6 children of the parent neighbourhood are far
+        # depends only on the parity of the vertex cell
+        for px in (0, 1):
+            for py in (0, 1):
+                ids = np.flatnonzero((cx % 2 == px) & (cy % 2 == py))
+                vx, vy, vcx, vcy = x[ids], y[ids], cx[ids], cy[ids]
+                sx, sy = np.zeros(len(ids)), np.zeros(len(ids))
+                for dx in range(-2 - px, 4 - px):
+                    tx = vcx + dx
+                    x_in = (tx >= 0) & (tx < side)
+                    for dy in range(-2 - py, 4 - py):
+                        if abs(dx) <= 1 and abs(dy) <= 1:
+                            continue
+                        ty = vcy + dy
+                        inside = x_in & (ty >= 0) & (ty < side)
+                        t = np.where(inside, ty * side + tx, 0)
+                        m = np.where(inside, mass[t], 0)
+                        ddx, ddy = vx - mx[t], vy - my[t]
+                        f = m / np.maximum(ddx*ddx + ddy*ddy, MIN_DISTANCE**2)
+                        sx += ddx * f
+                        sy += ddy * f
+                fx[ids] += sx * k2
+                fy[ids] += sy * k2
+
+    # near field: vertices in adjacent cells of the finest grid repel exactly
+    order = np.argsort(keys, kind='stable')
+    starts = np.searchsorted(keys[order], np.arange(side*side + 1))
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            tx, ty = cx + dx, cy + dy
+            ids = np.flatnonzero((tx >= 0) & (tx < side) & (ty >= 0) & (ty < side))
+            t = ty[ids] * side + tx[ids]
+            counts = starts[t+1] - starts[t]
+            i = np.repeat(ids, counts)
+            first = np.repeat(starts[t] - np.cumsum(counts) + counts, counts)
+            j = order[first + np.arange(len(i))]
+            i, j = i[i != j], j[i != j]
+            ddx, ddy = x[i] - x[j], y[i] - y[j]
+            f = k2 / np.maximum(ddx*ddx + ddy*ddy, MIN_DISTANCE**2)
+            fx += np.bincount(i, ddx * f, minlength=n)
+            fy += np.bincount(i, ddy * f, minlength=n)
+    return np.stack([fx, fy], 1)
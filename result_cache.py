@@ -0,0 +1,117 @@
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Union
+
+import numpy as np
+
+# results are kept here, one .npy file per key
+RESULT_CACHE_DIR = os.environ.get(
+    'RICCI_RESULT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'ricci', 'results'))
+# default size limit of a cache directory
+RESULT_CACHE_BYTES = 2**30
+
+
+@contextmanager
+def atomic_write(path: str, mode='wb'):
+    """Open a temporary file next to path, moved over path once written.
+
+    Readers never see a partial file, and a failed or interrupted write keeps
+    the old one; a killed process leaves path + '.<random>.tmp' behind.
+    """
+    f = tempfile.NamedTemporaryFile(mode, dir=os.path.dirname(path) or '.',
+                                    prefix=os.path.basename(path) + '.', suffix='.tmp', delete=False)
+    try:
+        with f:
+            yield f
+        os.replace(f.name, path)
+    except BaseException:
+        os.remove(f.name)
+        raise
+
+
+def content_key(*parts) -> str:
+    """Hash of arrays (their dtype, shape and contents) and of other values by repr."""
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(('%s%s' % (part.dtype.str, part.shape)).encode())
+            h.update(np.ascontiguousarray(part).data)
+        else:
+            h.update(repr(part).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class ResultCache:
+    """Arrays stored on disk as .npy files under content keys.
+
+    When the files take more than max_bytes, the least recently used ones are
+    removed; the modification time of a file marks its last use.
+    """
+
+    key = staticmethod(content_key)
+
+    def __init__(self, directory: str = RESULT_CACHE_DIR, max_bytes: int = RESULT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def get(self, key: str, mmap=True) -> Union[np.ndarray, None]:
+        """Stored array, memory-mapped read-only by default, None if there is none."""
+        path = self._path(key)
+        try:
+            result = np.load(path, mmap_mode='r' if mmap else None)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return result
+
+    def put(self, key: str, array: np.ndarray):
+        """Store an array, unless it alone is larger than the cache."""
+        array = np.asarray(array)
+        if array.nbytes > self.max_bytes:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with atomic_write(self._path(key)) as f:
+            np.save(f, array)
+        self._evict()
+
+    def clear(self):
+        for entry in self._entries():
+            self._remove(entry.path)
+
+    def size(self) -> int:
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.npy')
+
+    def _entries(self):
+        try:
+            return [entry for entry in os.scandir(self.directory) if entry.name.endswith('.npy')]
+        except FileNotFoundError:
+            return []
+
+    def _evict(self):
+        files = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path: str):
+        # another process or thread may have removed it already
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass